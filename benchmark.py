@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+"""Benchmarks for statica builds on synthetic projects.
+
+It generates a project of the given size (pages, depth, languages, boxes per
+page, images per gallery and catalog lines), then times a full build, a
+no-op incremental rebuild, a rebuild after changing a single box, peak memory
+of each build, startup time (importing statica), Site discovery
+(Item.discover), loading the cached site model and Box.parse on their own.
+
+Results are appended to a json file and compared with the last run with the
+same parameters, so regressions show up (and make the exit status 1).
+
+Usage: ./benchmark.py --pages 1000 --languages 3 --results bench.json
+"""
+
+import os
+import sys
+import time
+import json
+import shutil
+import tempfile
+import subprocess
+from datetime import datetime
+from optparse import OptionParser
+
+from PIL import Image
+
+STATICA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'statica.py')
+LANGUAGE_CODES = ['ca', 'es', 'en', 'fr', 'de', 'it', 'pt', 'eu', 'gl', 'nl']
+WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod '
+    'tempor incididunt ut labore et dolore magna aliqua').split()
+
+BASE_TEMPLATE = """<!DOCTYPE html>
+<html lang="{{ current_language }}">
+<head>
+  <title>{{ page.title }}</title>
+  {{ css.style }}
+</head>
+<body>
+<ul>{% for item in menu %}<li><a href="{{ item.url() }}">{{ item.title }}</a></li>{% endfor %}</ul>
+{% block content %}{% endblock content %}
+{{ js.app }}
+</body>
+</html>
+"""
+
+PAGE_TEMPLATE = """{%% extends 'base.html' %%}
+{%% block content %%}
+<h1>{{ page.title }}</h1>
+%s
+{%% if page.gallery %%}{%% for img in gallery[page.gallery] %%}{{ img|thumbnail(120, 80) }}{%% endfor %%}{%% endif %%}
+{%% endblock content %%}
+"""
+
+
+def text(n, seed):
+    """n pseudo random words"""
+    return ' '.join([WORDS[(seed * 7 + i * 3) % len(WORDS)] for i in range(n)])
+
+
+def generate(path, pages=100, depth=3, languages=2, boxes=4, images=6, catalog=50, gallery_every=10):
+    """write a synthetic project into path"""
+    langs = LANGUAGE_CODES[:languages]
+    os.makedirs(os.path.join(path, 'templates'))
+    os.makedirs(os.path.join(path, 'resources', 'static', 'css'))
+    os.makedirs(os.path.join(path, 'resources', 'static', 'js'))
+    os.makedirs(os.path.join(path, 'resources', 'static', 'img'))
+    os.makedirs(os.path.join(path, 'resources', 'static', 'ico'))
+    Image.new('RGB', (64, 32), (20, 40, 60)).save(os.path.join(path, 'resources', 'static', 'img', 'logo.png'))
+    Image.new('RGB', (16, 16), (200, 40, 60)).save(os.path.join(path, 'resources', 'static', 'ico', 'favicon.ico'))
+    open(os.path.join(path, 'resources', 'static', 'css', 'style.css'), 'w').write('body { margin: 0; }\n')
+    open(os.path.join(path, 'resources', 'static', 'js', 'app.js'), 'w').write('var app = {};\n')
+
+    config = ['DOMAIN: http://example.com', 'DEFAULT_TEMPLATE: page', 'SINGLE_RENDER: true', 'LANGUAGES: [%s]' % ', '.join(langs), 'I18N:']
+    config.extend(['  %s: {name: %s}' % (lang, lang) for lang in langs])
+    open(os.path.join(path, 'config.yml'), 'w').write('\n'.join(config) + '\n')
+
+    open(os.path.join(path, 'templates', 'base.html'), 'w').write(BASE_TEMPLATE)
+    box_names = ['box_%i' % i for i in range(boxes)]
+    open(os.path.join(path, 'templates', 'page.html'), 'w').write(
+        PAGE_TEMPLATE % '\n'.join(['<div>{{ %s }}</div>' % name for name in box_names]))
+
+    # pages make a tree with `depth` levels
+    fanout = 2
+    while sum([fanout ** i for i in range(1, depth + 1)]) < pages:
+        fanout += 1
+    dirs = {}
+    for i in range(pages):
+        parent = (i - fanout) // fanout if i >= fanout else None
+        dirs[i] = parent is None and 'p%i' % i or os.path.join(dirs[parent], 'p%i' % i)
+
+    for lang in langs:
+        for i in range(pages):
+            page_dir = os.path.join(path, 'resources', lang, dirs[i])
+            os.makedirs(page_dir)
+            header = ['id: p%i' % i, 'template: page', 'title: %s %i' % (text(3, i), i),
+                'description: %s' % text(8, i)]
+            if images and i % gallery_every == 0:
+                header.append('gallery: g%i' % i)
+            open(os.path.join(page_dir, 'page.md'), 'w').write('\n'.join(header) + '\n\n')
+            for n, name in enumerate(box_names):
+                body = ['title: %s' % text(2, n), '', '## %s' % text(4, i + n), '', text(60, i * n), '',
+                    '* %s\n* %s' % (text(3, n), text(3, i)), '',
+                    '| a | b |\n|---|---|\n| %i | %i |' % (i, n)]
+                if n == 0:
+                    body.append('\nBox of {{ page.title }}')
+                open(os.path.join(page_dir, '%s.md' % name), 'w').write('\n'.join(body) + '\n')
+            if images and i % gallery_every == 0:
+                generate_gallery(page_dir, langs, 'g%i' % i, images, catalog)
+    return path
+
+
+def generate_gallery(page_dir, langs, name, images, catalog):
+    """images of a gallery and their catalogs (with catalog lines in total)"""
+    lines = dict([(lang, []) for lang in langs])
+    for n in range(images):
+        filename = '%s_%i' % (name, n)
+        Image.new('RGB', (640, 480), ((n * 40) % 256, (len(name) * 20) % 256, 90)).save(
+            os.path.join(page_dir, '%s.jpg' % filename))
+        for lang in langs:
+            lines[lang].extend(['%s.title:%s %s' % (filename, lang, text(3, n)),
+                '%s.alt:%s' % (filename, text(2, n)), '%s.gallery:%s' % (filename, name)])
+    for lang in langs:
+        n = 0
+        while len(lines[lang]) < catalog:
+            lines[lang].append('unused_%i.title:%s' % (n, text(3, n)))
+            n += 1
+        open(os.path.join(page_dir, 'catalog.%s' % lang), 'w').write('\n'.join(lines[lang]) + '\n')
+
+
+def run_build(project, args=()):
+    """run statica in a child process, returns (seconds, peak rss in KB)"""
+    cwd, name = os.path.split(project)
+    start = time.time()
+    devnull = open(os.devnull, 'w')
+    child = subprocess.Popen([sys.executable, STATICA] + list(args) + [name], cwd=cwd, stdout=devnull, stderr=devnull)
+    pid, status, usage = os.wait4(child.pid, 0)
+    seconds = time.time() - start
+    if status:
+        sys.exit('Error: build of %s failed, run statica.py on it to see why.' % project)
+    return seconds, usage.ru_maxrss
+
+
+def time_startup():
+    """seconds to start statica (imports) and exit"""
+    devnull = open(os.devnull, 'w')
+    start = time.time()
+    subprocess.call([sys.executable, STATICA, '--version'], stdout=devnull, stderr=devnull)
+    return time.time() - start
+
+
+def time_discovery(project):
+    """seconds to load a Site (Item.discover), to load it from its cached model
+    and to parse all its boxes again"""
+    sys.path.insert(0, os.path.dirname(STATICA))
+    import statica
+    cwd = os.getcwd()
+    os.chdir(os.path.dirname(project))
+    try:
+        start = time.time()
+        site = statica.Site(os.path.basename(project)).load(cached=False)
+        discovery = time.time() - start
+        start = time.time()
+        statica.Site(os.path.basename(project)).load()
+        cached = time.time() - start
+        filenames = [box.filename for pages in site.pages.values() for m in pages.values() for box in m.boxes.values()]
+        start = time.time()
+        for filename in filenames:
+            statica.Box(filename)
+        parse = time.time() - start
+    finally:
+        os.chdir(cwd)
+    return discovery, cached, parse
+
+
+def benchmark(project, jobs=1):
+    """all measures for a generated project"""
+    results = {}
+    args = jobs > 1 and ['-j', str(jobs)] or []
+    results['full_build'], results['full_build_rss_kb'] = run_build(project, args)
+    results['noop_rebuild'], results['noop_rebuild_rss_kb'] = run_build(project, ['-i'] + args)
+
+    # change the deepest box
+    deepest = None
+    for root, dirs, files in os.walk(os.path.join(project, 'resources')):
+        if 'box_0.md' in files and (deepest is None or root.count(os.sep) > deepest.count(os.sep)):
+            deepest = root
+    if deepest:
+        open(os.path.join(deepest, 'box_0.md'), 'a').write('\nOne more line.\n')
+        results['one_change_rebuild'], results['one_change_rebuild_rss_kb'] = run_build(project, ['-i'] + args)
+
+    results['startup'] = time_startup()
+    results['discovery'], results['cached_load'], results['box_parse'] = time_discovery(project)
+    return results
+
+
+def compare(previous, results, threshold):
+    """print changes against previous results, returns names of regressions"""
+    regressions = []
+    print "%-28s %12s %12s %8s" % ('measure', 'previous', 'now', 'change')
+    for name in sorted(results):
+        now = results[name]
+        before = previous and previous.get(name)
+        if not before:
+            print "%-28s %12s %12.3f" % (name, '-', now)
+            continue
+        change = float(now - before) / before
+        flag = ''
+        if change > threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print "%-28s %12.3f %12.3f %+7.1f%%%s" % (name, before, now, change * 100, flag)
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--pages', type='int', default=100, help='pages per language')
+    parser.add_option('--depth', type='int', default=3, help='levels of the page tree')
+    parser.add_option('--languages', type='int', default=2)
+    parser.add_option('--boxes', type='int', default=4, help='boxes per page')
+    parser.add_option('--images', type='int', default=6, help='images per gallery')
+    parser.add_option('--catalog', type='int', default=50, help='lines per catalog')
+    parser.add_option('-j', '--jobs', type='int', default=1, help='passed to statica.py')
+    parser.add_option('--results', default='benchmark.json', help='json file with previous results')
+    parser.add_option('--threshold', type='float', default=0.2,
+        help='relative slowdown reported as a regression (default 0.2)')
+    parser.add_option('--keep', action='store_true', default=False, help="don't remove the generated project")
+    options, args = parser.parse_args()
+
+    params = dict(pages=options.pages, depth=options.depth, languages=options.languages,
+        boxes=options.boxes, images=options.images, catalog=options.catalog, jobs=options.jobs)
+    tmp = tempfile.mkdtemp(prefix='statica-bench-')
+    project = os.path.join(tmp, 'site')
+    try:
+        start = time.time()
+        generate(project, pages=options.pages, depth=options.depth, languages=options.languages,
+            boxes=options.boxes, images=options.images, catalog=options.catalog)
+        print "Project generated in %.2fs: %s" % (time.time() - start, project)
+        results = benchmark(project, jobs=options.jobs)
+    finally:
+        if not options.keep:
+            shutil.rmtree(tmp)
+
+    history = []
+    if os.path.exists(options.results):
+        history = json.load(open(options.results))
+    previous = [x['results'] for x in history if x['params'] == params]
+    regressions = compare(previous and previous[-1], results, options.threshold)
+    history.append(dict(date=datetime.now().isoformat(), params=params, results=results))
+    json.dump(history, open(options.results, 'w'), indent=2)
+    if regressions:
+        sys.exit('Regressions: %s' % ', '.join(regressions))
@@ -13,19 +13,85 @@ import os
 import sys
 import re
 import codecs
-import pickle
-import md5
+import json
+import time
+import cPickle as pickle
+import threading
+import traceback
+import multiprocessing
+import SocketServer
+import BaseHTTPServer
+import SimpleHTTPServer
+import hashlib
+import importlib
+import posixpath
+import fcntl
+import gzip
+import unicodedata
+import gc
+import resource
+from cStringIO import StringIO
+from multiprocessing.pool import ThreadPool
+from HTMLParser import HTMLParser
 from datetime import date
+from contextlib import contextmanager
 from os.path import join, getsize
+from optparse import OptionParser
 
-import yaml
 import shutil
-import markdown
-
-from PIL import Image, ImageOps
 import jinja2.exceptions
-from jinja2 import Environment, FileSystemLoader, Template
-from jinja2 import evalcontextfilter, contextfilter, Markup, escape
+from jinja2 import Environment, FileSystemLoader, FunctionLoader, ChoiceLoader, Template
+from jinja2 import FileSystemBytecodeCache
+from jinja2.bccache import Bucket
+from jinja2 import evalcontextfilter, contextfilter, contextfunction, Markup, escape
+
+
+
+class LazyModule:
+    """A module imported the first time one of its attributes is used.
+
+    Heavy dependencies are only imported by the phases needing them (PIL when
+    images are processed, markdown when a box is converted...). An optional
+    module is false if it can't be imported.
+    """
+    def __init__(self, name, optional=False):
+        self._name = name
+        self._optional = optional
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            try:
+                self._module = importlib.import_module(self._name)
+            except ImportError:
+                if not self._optional:
+                    raise
+                self._module = False
+        return self._module
+
+    def __getattr__(self, attr):
+        if attr.startswith('__'):
+            raise AttributeError(attr)
+        module = self._load()
+        if module is False:
+            raise AttributeError(attr)
+        return getattr(module, attr)
+
+    def __nonzero__(self):
+        return self._load() is not False
+
+yaml = LazyModule('yaml')
+markdown = LazyModule('markdown')
+Image = LazyModule('PIL.Image')
+ImageOps = LazyModule('PIL.ImageOps')
+features = LazyModule('PIL.features')
+pyinotify = LazyModule('pyinotify', optional=True)
+brotli = LazyModule('brotli', optional=True)
+
+try:
+    from jsmin import jsmin
+except ImportError:
+    jsmin = None
 
 #IMG_EXTENSION = ['jpg', 'jpeg', 'png', 'gif']
 STATIC_EXTENSIONS= {
@@ -39,15 +105,214 @@ STATIC_EXTENSIONS= {
     'installers': ['deb', 'rpm', 'apk', 'dmg', 'exe', 'msi'],
     'others': ['xcf', 'svg']
 }
+SOURCE_PATH = os.path.splitext(os.path.abspath(__file__))[0] + '.py'
 SLOT_EMPTY = 'SLOT EMPTY - PLEASE FILL IN'
+THUMBNAIL_RESAMPLE = 'ANTIALIAS' # name of a PIL.Image filter
+BOX_EXTENSIONS = ['md', 'markdown']
+SITEMAP_SHARD_SIZE = 50000 # urls in a sitemap file (the protocol limit)
+SEARCH_PREFIX = 2 # letters of the terms in a shard of the search index
+SEARCH_MIN_STEM = 3
+SEARCH_WEIGHTS = {'title': 10, 'description': 3, 'text': 1}
+# suffixes (and their replacement) removed from words without accents, the
+# first one found is used (see stem)
+SEARCH_STEMMERS = {
+    'en': [('sses', 'ss'), ('ies', 'y'), ('ss', 'ss'), ('us', 'us'), ('ingly', ''), ('edly', ''),
+        ('ness', ''), ('ment', ''), ('ing', ''), ('ed', ''), ('ly', ''), ('s', '')],
+    'es': [('amientos', ''), ('imientos', ''), ('amiento', ''), ('imiento', ''), ('mente', ''),
+        ('ces', 'z'), ('os', ''), ('as', ''), ('es', ''), ('o', ''), ('a', ''), ('e', ''), ('s', '')],
+    'ca': [('aments', ''), ('ament', ''), ('ments', ''), ('ment', ''), ('ques', 'c'), ('gues', 'g'),
+        ('gua', 'g'), ('ges', 'j'), ('ces', 'c'), ('ons', ''), ('es', ''), ('os', ''), ('a', ''),
+        ('e', ''), ('o', ''), ('s', '')],
+}
+SEARCH_STOPWORDS = {
+    'en': 'a an and are as at be but by for from in is it not of on or that the this to was were with',
+    'es': 'al como con de del el en es la las lo los mas no o para pero por que se son su sus un una unas unos y',
+    'ca': 'al als amb com de del dels el els en es hi ho i la les mes no o per pero que se seu seus seva seves son un una unes uns',
+}
+COPY_THREADS = 8 # threads copying static files
+COMPRESS_EXTENSIONS = ['html', 'css', 'js', 'xml', 'svg', 'txt', 'json']
+HTML_MINIFY_RE = re.compile(r'(<(pre|textarea|script|style)\b.*?</\2\s*>)|(<!--(?!\[if).*?-->)|(\s+)', re.S | re.I)
+CSS_COMMENT_RE = re.compile(r'/\*(?!!).*?\*/', re.S)
+HTML_TAG_RE = re.compile(r'<[^>]*>')
+JINJA_TAG_RE = re.compile(r'{[{%#].*?[}%#]}', re.S)
+SEARCH_MARKS_RE = re.compile(u'[\u0300-\u036f\u00b7]') # accents (after NFD) and the middle dot of catalan l.l
+SEARCH_WORD_RE = re.compile(r'[^a-z0-9]+')
+CSS_URL_RE = re.compile(r'''url\(\s*(['"]?)([^'"\)]+)\1\s*\)''')
+FINGERPRINT_TYPES = ['style', 'javascript', 'image']
+IMAGE_DEFAULTS = {'widths': [], 'quality': 85, 'webp': False, 'sizes': '100vw'}
+PUBLISH_MANIFEST = '.statica-publish.json' # in the target of --publish, what's there
+EXISTS_DEP = 'exists:' # prefix of deps that only matter by being there (see Manifest.signature)
+FICLONE = 0x40049409 # linux ioctl to reflink a file (btrfs, xfs...)
+LIVE_RELOAD_URL = '/__statica__/reload'
+LIVE_RELOAD_SCRIPT = '''<script>(function() {
+  var generation = null;
+  setInterval(function() {
+    var request = new XMLHttpRequest();
+    request.onload = function() {
+      if (generation !== null && generation != request.responseText) { location.reload(); }
+      generation = request.responseText;
+    };
+    request.open('GET', '%s', true);
+    request.send();
+  }, 1000);
+})();</script>''' % LIVE_RELOAD_URL
+SEARCH_SCRIPT = '''// client of the search index written by statica (build/search/<lang>/)
+function StaticaSearch(root, lang) {
+  this.root = root; // url of build/, relative to the page
+  this.base = root + 'search/' + lang + '/';
+  this.meta = null;
+  this.shards = {};
+}
+
+StaticaSearch.prototype.fetch = function (name, callback) {
+  var request = new XMLHttpRequest();
+  request.onload = function () { callback(request.status == 200 ? JSON.parse(request.responseText) : {}); };
+  request.onerror = function () { callback({}); };
+  request.open('GET', this.base + name + '.json', true);
+  request.send();
+};
+
+// words of text as index terms: no accents, no stopwords, stemmed
+StaticaSearch.prototype.terms = function (text) {
+  var meta = this.meta, terms = [];
+  var words = text.toLowerCase().normalize('NFD').replace(/[\\u0300-\\u036f\\u00b7]/g, '').split(/[^a-z0-9]+/);
+  for (var i = 0; i < words.length; i++) {
+    var word = words[i];
+    if (word.length < 2 || meta.stopwords.indexOf(word) >= 0) { continue; }
+    for (var j = 0; j < meta.rules.length; j++) {
+      var suffix = meta.rules[j][0];
+      if (word.length - suffix.length >= meta.min_stem && word.slice(word.length - suffix.length) == suffix) {
+        word = word.slice(0, word.length - suffix.length) + meta.rules[j][1];
+        break;
+      }
+    }
+    terms.push(word);
+  }
+  return terms;
+};
+
+// calls callback with the pages (url, title, description) having every term
+// of query, the best first; the last term also matches as a prefix
+StaticaSearch.prototype.search = function (query, callback, limit) {
+  var self = this;
+  if (!this.meta) {
+    this.fetch('index', function (meta) { self.meta = meta; self.search(query, callback, limit); });
+    return;
+  }
+  var terms = this.terms(query), missing = [];
+  for (var i = 0; i < terms.length; i++) {
+    var name = terms[i].slice(0, this.meta.prefix);
+    if (!(name in this.shards) && missing.indexOf(name) < 0 && this.meta.shards.indexOf(name) >= 0) { missing.push(name); }
+  }
+  if (missing.length) {
+    var pending = missing.length;
+    for (var i = 0; i < missing.length; i++) {
+      (function (name) {
+        self.fetch(name, function (shard) {
+          self.shards[name] = shard;
+          if (--pending === 0) { self.search(query, callback, limit); }
+        });
+      })(missing[i]);
+    }
+    return;
+  }
+  var scores = {}, matches = {};
+  for (var i = 0; i < terms.length; i++) {
+    var shard = this.shards[terms[i].slice(0, this.meta.prefix)] || {}, found = {};
+    for (var term in shard) {
+      if (term != terms[i] && !(i == terms.length - 1 && term.indexOf(terms[i]) === 0)) { continue; }
+      var postings = shard[term];
+      for (var j = 0; j < postings.length; j += 2) {
+        var doc = postings[j];
+        scores[doc] = (scores[doc] || 0) + postings[j + 1] * (term == terms[i] ? 2 : 1);
+        found[doc] = true;
+      }
+    }
+    for (var doc in found) { matches[doc] = (matches[doc] || 0) + 1; }
+  }
+  var results = [];
+  for (var doc in matches) {
+    if (matches[doc] == terms.length) {
+      var d = this.meta.docs[doc];
+      results.push({url: this.root + d[0], title: d[1], description: d[2], score: scores[doc]});
+    }
+  }
+  results.sort(function (a, b) { return b.score - a.score; });
+  callback(results.slice(0, limit || 20));
+};
+'''
 PAGE = None
 LANGUAGES = None
 GALLERY = {}
 BUILD_DIR = None
+CACHE_DIR = None
+SHARED_CACHE_DIR = None # content keyed caches shared by projects (--cache-dir)
+SHARED_CACHES = {} # name -> Cache kept in SHARED_CACHE_DIR, see shared_cache()
+CACHE_KEYS = {} # cache_path() name -> keys of the files in use, see prune_cache()
+MANIFEST = None
+CONTENT_CACHE = None
+CATALOG_CACHE = None
+OUTPUT_CACHE = None # output -> (processed copy, source signature, options), see post_process
+POST_PROCESS = None # (MINIFY, COMPRESS) in config.yml when any of them is set
+FINGERPRINTS = None # asset url -> url with its hash (with FINGERPRINT in config.yml)
+IMAGE_OPTIONS = None # IMAGES in config.yml, with IMAGE_DEFAULTS
+CATALOGS = {} # directory -> Catalog
+MISSING = set() # (image, field) without value, already reported
+BOX_SOURCES = {} # template name -> html of boxes with jinja2 code
+NAV_CACHE = {} # navigation markup shared by pages, see navigation()
+UP_PREFIXES = {} # level -> '../' * level
 ENV = None
-
-# initialize makdown object
-md = markdown.Markdown(safe_mode=False, extensions=['tables']) #, 'superscript'])
+SITE = None
+
+# markdown extensions, MARKDOWN_EXTENSIONS in config.yml replaces them
+MARKDOWN_DEFAULT_EXTENSIONS = ['tables'] #, 'superscript']
+MARKDOWN_EXTENSIONS = MARKDOWN_DEFAULT_EXTENSIONS
+CONVERTERS = threading.local() # a markdown object for each thread
+PENDING_BOXES = None # boxes to convert once discovery is done (see Site.load)
+SEARCH_CACHE = None # lang/page id -> (sources key, document, terms), see page_search()
+HTML_PARSER = HTMLParser() # for its unescape()
+STREAM = False # boxes are only loaded while their page is rendered, see build()
+SINGLE_RENDER = False # pages are rendered once, boxes with jinja2 code on their own (SINGLE_RENDER in config.yml)
+MEMORY_LIMIT = None # bytes, caches are freed over it in streaming builds
+MEMORY_CHECK = 0 # bytes, the next check_memory() frees caches over it
+MEMORY_WARNED = False
+
+def converter():
+    """markdown object of the current thread (and process) with MARKDOWN_EXTENSIONS"""
+    extensions = tuple(MARKDOWN_EXTENSIONS)
+    if getattr(CONVERTERS, 'extensions', None) != extensions:
+        CONVERTERS.md = markdown.Markdown(safe_mode=False, extensions=list(extensions))
+        CONVERTERS.extensions = extensions
+    return CONVERTERS.md
+
+def markdown_to_html(text):
+    """convert markdown to html (runs in worker processes too)"""
+    md = converter()
+    try:
+        html = md.convert(text)
+    finally:
+        md.reset() # nothing is kept for the next document
+    # add bootstrap styles to tables
+    return html.replace('<table>', '<table class="table table-striped">')
+
+def convert_boxes(boxes, jobs=1):
+    """convert (box, cache key) pairs parsed without html, in a pool of worker processes if jobs > 1"""
+    with PROFILE.phase('markdown'):
+        texts = [box.md for box, key in boxes]
+        if jobs > 1 and len(texts) > 1:
+            pool = multiprocessing.Pool(min(jobs, len(texts)))
+            try:
+                htmls = pool.map(markdown_to_html, texts, chunksize=max(1, len(texts) // (jobs * 4)))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            htmls = [markdown_to_html(text) for text in texts]
+    for (box, key), html in zip(boxes, htmls):
+        box.html = html
+        box.set_template()
+        if key is not None:
+            CONTENT_CACHE.set(key, (box.header, box.md, box.html))
 
 def clean_line(line):
     """clean data line before process it"""
@@ -55,6 +320,257 @@ def clean_line(line):
         line = line[:-1]
     return line
 
+def memory_usage():
+    """resident memory of this process in bytes (0 without /proc)"""
+    try:
+        return int(open('/proc/self/statm').read().split()[1]) * resource.getpagesize()
+    except (IOError, ValueError, IndexError):
+        return 0
+
+def check_memory():
+    """free caches when this process goes over MEMORY_LIMIT
+
+    RSS seldom goes down in CPython, so once over the limit caches are only
+    freed again after it grows by another tenth of the limit.
+    """
+    global MEMORY_CHECK, MEMORY_WARNED
+    if not MEMORY_LIMIT or memory_usage() <= max(MEMORY_LIMIT, MEMORY_CHECK):
+        return
+    with PROFILE.phase('free memory'):
+        # the ones growing with the site: navigation of every directory and
+        # signatures of every file read (taken from disk again when needed)
+        NAV_CACHE.clear()
+        MANIFEST.signatures.clear()
+        BOX_SOURCES.clear()
+        if ENV is not None and ENV.cache is not None:
+            ENV.cache.clear()
+        gc.collect()
+    usage = memory_usage()
+    MEMORY_CHECK = usage + MEMORY_LIMIT // 10
+    if usage > MEMORY_LIMIT and not MEMORY_WARNED:
+        print "Warning: %i MB in use, over the limit of %i MB." % (usage >> 20, MEMORY_LIMIT >> 20)
+        MEMORY_WARNED = True
+
+def peak_memory():
+    """peak resident memory in KB of this process and of its finished children"""
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+def cache_path(name):
+    """directory of a cache keyed by content, in SHARED_CACHE_DIR if there is one"""
+    return ensure_dir(os.path.join(SHARED_CACHE_DIR or CACHE_DIR, name))
+
+def prune_files(directory, keys):
+    """delete files of a cache directory whose key (their name up to the first dot) isn't in keys"""
+    for name in os.listdir(directory):
+        if name.split('.')[0] not in keys:
+            os.remove(os.path.join(directory, name))
+
+def prune_cache(name, keys):
+    """delete files of cache_path(name) whose key isn't in keys, or in the
+    keys of other projects when the cache is shared (see build_batch)"""
+    CACHE_KEYS.setdefault(name, set()).update(keys)
+    if SHARED_CACHE_DIR is None:
+        prune_files(cache_path(name), CACHE_KEYS.pop(name))
+
+def ensure_dir(path):
+    """create a directory (and its parents) if it doesn't exist yet"""
+    if not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            if not os.path.isdir(path): # not created by another process
+                raise
+    return path
+
+def reflink(src, dst):
+    """share the blocks of src with a new file dst (copy on write filesystems only)"""
+    fsrc = open(src, 'rb')
+    fdst = open(dst, 'wb')
+    try:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except IOError:
+            fdst.close()
+            os.remove(dst)
+            raise
+    finally:
+        fsrc.close()
+        fdst.close()
+
+def link_or_copy(src, dst, hardlink=True):
+    """hardlink src to dst (reflink or copy it on other filesystems, or if
+    hardlink is False), replacing dst atomically"""
+    tmp = '%s.%i.%i.tmp' % (dst, os.getpid(), threading.current_thread().ident)
+    try:
+        if not hardlink:
+            raise OSError('copy requested')
+        os.link(src, tmp)
+    except (OSError, AttributeError):
+        try:
+            reflink(src, tmp)
+        except IOError:
+            shutil.copyfile(src, tmp)
+        shutil.copystat(src, tmp) # same_file() compares mtimes
+    os.rename(tmp, dst)
+
+def store_static(src):
+    """path of a copy of src in SHARED_CACHE_DIR/static, named after its content
+
+    Static files of every project are linked from there, so identical files
+    of several projects take the space of one. The copy isn't a hardlink of
+    src, editing the resources of a project must not change other ones.
+    """
+    stored = os.path.join(cache_path('static'), MANIFEST.signature(src)[2])
+    PROFILE.hit('static store', os.path.exists(stored))
+    if not os.path.exists(stored):
+        link_or_copy(src, stored, hardlink=False)
+    return stored
+
+def same_file(src, dst):
+    """True if dst already is a copy of src (same size and mtime, or same content)"""
+    try:
+        a = os.stat(src)
+        b = os.stat(dst)
+    except OSError:
+        return False
+    if a.st_size != b.st_size:
+        return False
+    if (a.st_dev, a.st_ino) == (b.st_dev, b.st_ino) or int(a.st_mtime) == int(b.st_mtime):
+        return True
+    if file_hash(src) != file_hash(dst):
+        return False
+    os.utime(dst, (b.st_atime, a.st_mtime)) # don't hash it again next time
+    return True
+
+def file_signature(path):
+    """(size, mtime) of a file, None if it doesn't exist"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_size, int(st.st_mtime)
+
+def file_hash(path):
+    """md5 hex digest of a file, read in chunks"""
+    h = hashlib.md5()
+    f = open(path, 'rb')
+    try:
+        chunk = f.read(65536)
+        while chunk:
+            h.update(chunk)
+            chunk = f.read(65536)
+    finally:
+        f.close()
+    return h.hexdigest()
+
+def write_output(path, content):
+    """write an output file (unicode is saved as utf-8), replacing it atomically
+
+    A file that already has that content (or its minified copy, see
+    post_process) isn't touched, so its mtime only changes with it (see
+    deploy_manifest). Returns True if it was written.
+    """
+    if isinstance(content, unicode):
+        content = content.encode('utf-8')
+    try:
+        unchanged = (processed_output(path, content)
+            or os.path.getsize(path) == len(content) and open(path, 'rb').read() == content)
+    except (OSError, IOError):
+        unchanged = False
+    PROFILE.hit('unchanged outputs', unchanged)
+    if unchanged:
+        return False
+    # a new file: the old one can be a hardlink (see post_process)
+    tmp = '%s.%i.tmp' % (path, os.getpid())
+    f = open(tmp, 'wb')
+    f.write(content)
+    f.close()
+    os.rename(tmp, path)
+    PROFILE.written(len(content))
+    return True
+
+
+class Profile:
+    """Wall time and counters of a build by phase, template and page (see --profile)"""
+    def __init__(self):
+        self.start = time.time()
+        self.phases = {} # name -> [seconds, calls]
+        self.templates = {} # name -> [seconds, calls]
+        self.pages = {} # lang/id -> seconds
+        self.caches = {} # name -> [hits, misses]
+        self.bytes_written = 0
+        self.files_written = 0
+
+    @contextmanager
+    def phase(self, name, table=None):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - start, table)
+
+    def add(self, name, seconds, table=None):
+        entry = (self.phases if table is None else table).setdefault(name, [0.0, 0])
+        entry[0] += seconds
+        entry[1] += 1
+
+    def hit(self, cache, hit):
+        """count a hit (or a miss) in a cache"""
+        self.caches.setdefault(cache, [0, 0])[not hit and 1 or 0] += 1
+
+    def written(self, size):
+        self.bytes_written += size
+        self.files_written += 1
+
+    def data(self):
+        return dict(phases=self.phases, templates=self.templates, pages=self.pages,
+            caches=self.caches, bytes_written=self.bytes_written, files_written=self.files_written)
+
+    def merge(self, data):
+        """add data() of a profile from a worker process"""
+        for table in ('phases', 'templates', 'caches'):
+            mine = getattr(self, table)
+            for name, values in data[table].items():
+                old = mine.setdefault(name, [0] * len(values))
+                mine[name] = [a + b for a, b in zip(old, values)]
+        self.pages.update(data['pages'])
+        self.bytes_written += data['bytes_written']
+        self.files_written += data['files_written']
+
+    def report(self, top=10):
+        """whole profile as a dictionary, ready to be saved as json"""
+        def table(entries):
+            return [dict(name=name, seconds=round(v[0], 4), count=v[1])
+                for name, v in sorted(entries.items(), key=lambda x: -x[1][0])]
+        caches = []
+        for name, (hits, misses) in sorted(self.caches.items()):
+            caches.append(dict(name=name, hits=hits, misses=misses,
+                hit_rate=round(float(hits) / ((hits + misses) or 1), 4)))
+        slowest = sorted(self.pages.items(), key=lambda x: -x[1])[:top]
+        return dict(total_seconds=round(time.time() - self.start, 4),
+            phases=table(self.phases), templates=table(self.templates),
+            pages=len(self.pages), slowest_pages=[dict(page=n, seconds=round(t, 4)) for n, t in slowest],
+            bytes_written=self.bytes_written, files_written=self.files_written, caches=caches)
+
+    def show(self, report):
+        """print a report as human readable tables"""
+        print "Build profile: %.2fs, %i pages, %i files (%i bytes) written." % (report['total_seconds'],
+            report['pages'], report['files_written'], report['bytes_written'])
+        for title, key in (('phase', 'phases'), ('template', 'templates')):
+            print "\n%-40s %10s %8s" % (title, 'seconds', 'count')
+            for row in report[key]:
+                print "%-40s %10.3f %8i" % (row['name'][-40:], row['seconds'], row['count'])
+        print "\n%-40s %10s" % ('slowest pages', 'seconds')
+        for row in report['slowest_pages']:
+            print "%-40s %10.3f" % (row['page'][-40:], row['seconds'])
+        print "\n%-40s %8s %8s %8s" % ('cache', 'hits', 'misses', 'rate')
+        for row in report['caches']:
+            print "%-40s %8i %8i %7.1f%%" % (row['name'], row['hits'], row['misses'], row['hit_rate'] * 100)
+
+PROFILE = Profile()
+
+
 def get_type(filename):
     """get type for a filename with its extension"""
     
@@ -86,19 +602,68 @@ def value_or_empty(value):
         res = ''
     return res
 
+def context_page(context):
+    """current page from a jinja2 context, global PAGE outside templates"""
+    if context is not None:
+        page = context.get('page')
+        if page is not None:
+            return page
+    return PAGE
+
+def up(level):
+    """'../' * level, the prefix of relative urls from a page at that level"""
+    try:
+        return UP_PREFIXES[level]
+    except KeyError:
+        return UP_PREFIXES.setdefault(level, '../' * level)
+
+def thumbnail_file(object, width, height):
+    """return the filename of a thumbnail, computing it only if it isn't cached
+
+    Thumbnails are named after the source content, the size and the resample
+    filter, so they are shared by all pages and languages and kept between
+    builds in CACHE_DIR/thumbnails (or SHARED_CACHE_DIR/thumbnails) while
+    they are in the build (see thumbnail_keys).
+    """
+    key = '%s:%ix%i:%s' % (MANIFEST.signature(object.path)[2], width, height, THUMBNAIL_RESAMPLE)
+    filename = '%s.%s' % (hashlib.md5(key).hexdigest(), object.filename.split('.')[-1].lower())
+    cached = os.path.join(cache_path('thumbnails'), filename)
+    PROFILE.hit('thumbnails', os.path.exists(cached))
+    if not os.path.exists(cached):
+        with PROFILE.phase('thumbnails'):
+            thumb = ImageOps.fit(object.image, (width, height), getattr(Image, THUMBNAIL_RESAMPLE))
+            # write and rename, other workers could be saving the same thumbnail
+            tmp_path = '%s.%i.tmp' % (cached, os.getpid())
+            thumb.save(tmp_path, object.format)
+            os.rename(tmp_path, cached)
+
+    path = os.path.join(ensure_dir(os.path.join(BUILD_DIR, 'static', 'img', 'thumbnail')), filename)
+    if not os.path.exists(path):
+        link_or_copy(cached, path)
+        PROFILE.written(os.path.getsize(path))
+    MANIFEST.record(path, [object.path])
+    return filename
+
+def thumbnail_keys():
+    """keys of the thumbnails in the build, forgetting the ones made from
+    an older version of their image (remove_orphans() deletes them)"""
+    directory = os.path.join(BUILD_DIR, 'static', 'img', 'thumbnail') + os.path.sep
+    keys = set()
+    for output, record in MANIFEST.outputs.items():
+        if not output.startswith(directory):
+            continue
+        if output in MANIFEST.built or not MANIFEST.changed(record['deps']):
+            keys.add(os.path.basename(output).split('.')[0])
+        else:
+            del MANIFEST.outputs[output]
+    return keys
+
 @contextfilter
 def thumbnail(context, object, width, height, style=""):
     """thumbnail filter for jinja2"""
-    thumb = ImageOps.fit(object.image, (width, height), Image.ANTIALIAS)
-    new_filename = '%s_%s' % (PAGE.lang, object.filename) #TODO: use md5sum
-    path = os.path.join(BUILD_DIR, 'static', 'img', 'thumbnail', new_filename)
-    url = '%s/static/img/thumbnail/%s' % ('../' * (PAGE.level + 1), new_filename)
-
-    try:
-        os.makedirs(os.path.join(BUILD_DIR, 'static', 'img', 'thumbnail'))
-    except:
-        pass
-    thumb.save(path)
+    page = context_page(context)
+    new_filename = thumbnail_file(object, width, height)
+    url = '%s/static/img/thumbnail/%s' % (up(page.level + 1), new_filename)
 
     if style:
         result = '<img class="%s" src="%s" title="%s" alt="%s" width="%i" height="%i" />' % (style, url, object.title, object.alt, width, height)
@@ -110,22 +675,129 @@ def thumbnail(context, object, width, height, style=""):
         result = Markup(result)
     return result
 
+def box_source(name):
+    """jinja2 loader function for boxes registered by Box.set_template()"""
+    if name in BOX_SOURCES:
+        return BOX_SOURCES[name], None, lambda: True
+
 @contextfilter
 def template(context, object, template):
     """template filter for jinja2"""
     template = ENV.get_template(template)
-    result = template.render(page=PAGE, object=object)
+    result = template.render(page=context_page(context), object=object)
+    if context.eval_ctx.autoescape:
+        result = Markup(result)
+    return result
+
+def nav_link(item, level):
+    """<a> of a page item for a page at level"""
+    title = getattr(item, 'title', None) or getattr(item, 'id', '')
+    return '<a href="%s%s/index.html">%s</a>' % (up(level), item._url, escape(title))
+
+def nav_list(items, level, depth, branch):
+    """<ul> of page items, and their children down to depth levels, for a page
+    at level. Items in branch (roots of the current page and its ancestors)
+    are marked as active; lists without any of them are kept in NAV_CACHE.
+    """
+    items = [x for x in items if x.type == 'page']
+    if depth < 1 or not items:
+        return ''
+    active = [x for x in items if x.root in branch]
+    key = ('list', items[0].parent.root, level, depth)
+    if not active and key in NAV_CACHE:
+        return NAV_CACHE[key]
+    result = ['<ul>']
+    for item in items:
+        if item in active:
+            result.append('<li class="active">%s%s</li>' % (nav_link(item, level),
+                nav_list(item.children, level, depth - 1, branch)))
+        else:
+            result.append('<li>%s%s</li>' % (nav_link(item, level),
+                nav_list(item.children, level, depth - 1, ())))
+    result.append('</ul>')
+    result = ''.join(result)
+    if not active:
+        NAV_CACHE[key] = result
+    return result
+
+def page_branch(page):
+    """items from the top of the menu down to page"""
+    branch = []
+    while page is not None and page.level > 0:
+        branch.insert(0, page)
+        page = page.parent
+    return branch
+
+@contextfunction
+def navigation(context, depth=1):
+    """menu of the current language down to depth levels, with the branch of
+    the current page marked as active (navigation function for jinja2)
+
+    The markup only depends on the level of the page and on the active items
+    it shows, so it is rendered once for all the pages sharing them (see
+    NAV_CACHE, cleared when the site is loaded again).
+    """
+    page = context_page(context)
+    branch = tuple([x.root for x in page_branch(page)[:depth]])
+    key = ('navigation', page.lang, page.level, depth, branch)
+    if key not in NAV_CACHE:
+        NAV_CACHE[key] = nav_list(SITE.menu[page.lang].children, page.level, depth, branch)
+    result = NAV_CACHE[key]
+    if context.eval_ctx.autoescape:
+        result = Markup(result)
+    return result
+
+@contextfunction
+def breadcrumb(context):
+    """links to the ancestors of the current page and its title (breadcrumb
+    function for jinja2), ancestors are shared by the pages of a directory"""
+    page = context_page(context)
+    key = ('breadcrumb', page.parent.root, page.level)
+    if key not in NAV_CACHE:
+        NAV_CACHE[key] = ''.join(['<li>%s</li>' % nav_link(x, page.level)
+            for x in page_branch(page.parent) if x.type == 'page'])
+    result = '<ol class="breadcrumb">%s<li class="active">%s</li></ol>' % (NAV_CACHE[key],
+        escape(getattr(page, 'title', None) or page.id))
+    if context.eval_ctx.autoescape:
+        result = Markup(result)
+    return result
+
+@contextfunction
+def siblings(context):
+    """links to the pages in the directory of the current page, itself marked
+    as active (siblings function for jinja2)"""
+    page = context_page(context)
+    key = ('siblings', page.parent.root, page.level)
+    if key not in NAV_CACHE:
+        NAV_CACHE[key] = [(x.root, '<li>%s</li>' % nav_link(x, page.level),
+            '<li class="active">%s</li>' % nav_link(x, page.level))
+            for x in page.parent.children if x.type == 'page']
+    result = '<ul>%s</ul>' % ''.join([root == page.root and active or link
+        for root, link, active in NAV_CACHE[key]])
+    if context.eval_ctx.autoescape:
+        result = Markup(result)
+    return result
+
+@contextfunction
+def search_script(context):
+    """<script> tags loading the search client, with a StaticaSearch object
+    for the language of the current page in statica_search (search_script
+    function for jinja2, see write_search)"""
+    page = context_page(context)
+    result = ('<script src="%ssearch/search.js"></script>\n'
+        '<script>var statica_search = new StaticaSearch("%s", "%s");</script>') % (up(page.level + 1), up(page.level + 1), page.lang)
     if context.eval_ctx.autoescape:
         result = Markup(result)
     return result
-    
+
 
 class Static:
-    """Basic Object for css, js and images resources"""
-    def __init__(self, path, type):
+    """Basic Object for css, js and images resources, level is the one of the
+    item (directory) holding it"""
+    def __init__(self, path, type, level=1):
         self.path = path
         self.type = type
-        self._url = '/'.join(path.split(os.path.sep)[2:])
+        self._url = '/'.join(path.split(os.path.sep)[-(level + 2):]) # from resources/
 
     def __repr__(self):
         if self.type == 'style':
@@ -138,12 +810,13 @@ class Static:
             res = self.url()
         return res
 
-    def url(self):
+    @contextfunction
+    def url(self, context=None):
         """returns a valid relative url"""
-        global PAGE
-        res = '../' * (PAGE.level + 1) + self._url
+        page = context_page(context)
+        res = up(page.level + 1) + asset_url(self._url)
         return res
-        
+
 
 
 class Item:
@@ -155,6 +828,7 @@ class Item:
         self.type = None
         self._index = []
         self.children = []
+        self.boxes = {}
         self.level = level
         self.lang = lang
         self._url = '/'.join(root.split(os.path.sep)[-level:])
@@ -170,10 +844,10 @@ class Item:
     def __unicode__(self):
         return self.url()
 
-    def url(self):
-        global PAGE
+    @contextfunction
+    def url(self, context=None):
         if self.type == 'page':
-            res = '../' * PAGE.level + self._url + '/index.html'
+            res = up(context_page(context).level) + self._url + '/index.html'
         #TODO: fix this
         elif self.type in ['javascript', 'style']:
             res = "TEST"
@@ -188,10 +862,11 @@ class Item:
         else:
             return '<%s: %s - %s>' % (self.type, self.root, self.lang)
 
-    def lang_url(self):
+    @contextfunction
+    def lang_url(self, context=None):
         """returns page url with lang"""
-        global PAGE
-        result = '../' * (PAGE.level + 1) + '%s/%s' % (self.lang, self._url)
+        page = context_page(context)
+        result = up(page.level + 1) + '%s/%s' % (self.lang, self._url)
         return result
 
     def add_value(self, name, item):
@@ -200,10 +875,13 @@ class Item:
             setattr(self, normalize(name), item)
 
     def add_child(self, name, item):
-        """help to build an ordered menu directly from directory structure"""
+        """help to build an ordered menu directly from directory structure
+
+        Children are appended as they are found and sorted once the whole
+        directory is discovered (see sort_children).
+        """
         self.add_value(name, item)
         item.parent = self # add parent (self) to item
-        l = len(self._index)
         if hasattr(item, 'id'):
             id = item.id
         elif self.type == 'page':
@@ -211,19 +889,14 @@ class Item:
             id = 'zzzz'
         else:
             id = None
-        if l > 0:
-            for i in range(len(self._index)):
-                if id <= self._index[i]:
-                    self._index.insert(i, id)
-                    self.children.insert(i, item)
-                    id = 'done'
-                    break
-            if id != 'done':
-                self._index.append(id)
-                self.children.append(item)
-        else:
-            self._index.append(id)
-            self.children.append(item)
+        self._index.append(id)
+        self.children.append(item)
+
+    def sort_children(self):
+        """order children by id, among equal ids the last added goes first"""
+        order = sorted(range(len(self.children)), key=lambda i: (self._index[i], -i))
+        self._index = [self._index[i] for i in order]
+        self.children = [self.children[i] for i in order]
 
     def parse_page(self):
         """read params from page.md -> key: value"""
@@ -231,9 +904,8 @@ class Item:
         if os.path.exists('%s/page.md' % self.root):
             self.type = 'page'
             self.box = Box('%s/page.md' % self.root)
-            lines = codecs.open('%s/page.md' % self.root, 'r', 'utf-8').readlines()
-            for line in lines:
-                data = clean_line(line).split(':')
+            # header lines are shared with the box of the page
+            for data in self.box.header:
                 key = data[0]
                 value = ''.join(data[1:]).strip('\r\n').strip() # drop '\n'
                 if value == '':
@@ -256,71 +928,119 @@ class Item:
                 t, basename = get_type(item)
                 if not self.type:
                     self.type = t
-                if t == 'image':
+                if self.type == 'page' and item.split('.')[-1].lower() in BOX_EXTENSIONS:
+                    # boxes are parsed once here and used when the page is rendered
+                    if item != 'page.md':
+                        self.boxes[item.split('.')[0]] = Box(path, lazy=STREAM)
+                elif t == 'image':
                     img = Img(item, path)
                     self.add_value(basename, img)
                     for lang in LANGUAGES:
-                        gallery = getattr(img, '_gallery_%s' % lang) or None
-                        if gallery:
-                            if GALLERY[lang].has_key(gallery):
-                                GALLERY[lang][gallery].append(img)
-                            else:
-                                GALLERY[lang][gallery] = [img]
+                        gallery = img.value('gallery', lang, fallback=False)
+                        if not gallery:
+                            continue
+                        # an image in the trees of several languages is listed once,
+                        # the copy in the tree of the gallery language if there is one
+                        images = GALLERY[lang].setdefault(gallery, [])
+                        same = [i for i, x in enumerate(images) if x.filename == img.filename]
+                        if not same:
+                            images.append(img)
+                        elif self.lang == lang:
+                            images[same[0]] = img
                 else:
-                    self.add_value(basename, Static(path, t)) #TODO: use an object too
+                    self.add_value(basename, Static(path, t, self.level)) #TODO: use an object too
+        self.sort_children()
         return self
 
 
-class Img:
+class Img(object):
+    """Image resource. Pixel data is only read when a filter needs it (see image)"""
     def __init__(self, filename, path):
-        global BUILD_DIR
         self.filename = filename
+        self.path = path
         self.name = '.'.join(filename.split('.')[:-1]).lower()
-        self.image = Image.open(path)
-        self.image_raw = open(path, 'rb').read()
+        self.read_header()
         self._url = 'static/img/%s' % self.filename
-        self.build_path = os.path.join(BUILD_DIR, 'static', 'img', self.filename)
-        dirname = os.path.dirname(path)
-        self.read_catalog(dirname)
-        self.save()
+        self.catalog = Catalog.get(os.path.dirname(path))
 
-    def url(self):
-        # here we use the current page defined into main loop (it's a global variable)
-        global PAGE
-        result = '../' * (PAGE.level + 1) + self._url
+    def read_header(self):
+        """read format, width and height from the image header without decoding it"""
+        with PROFILE.phase('image headers'):
+            f = open(self.path, 'rb')
+            try:
+                image = Image.open(f)
+                self.format = image.format
+                self.width, self.height = image.size
+            finally:
+                f.close()
+
+    @property
+    def image(self):
+        """PIL image, opened on demand and not kept by this object"""
+        return Image.open(self.path)
+
+    @contextfunction
+    def url(self, context=None):
+        # current page comes from the template context (or the PAGE global outside templates)
+        page = context_page(context)
+        result = up(page.level + 1) + asset_url(self._url)
         return result
 
-    def read_catalog(self, dirname):
-        """read translated info about the image from language catalogs"""
-        global LANGUAGES
-        for lang in LANGUAGES:
-            try:
-                lines = codecs.open('%s/catalog.%s' % (dirname, lang), 'r', 'utf-8').readlines()
-            except IOError:
-                break
-            for line in lines:
-                if line.startswith('%s.' % self.name):
-                    key = line.split(':')[0].split('.')[1].strip() # format line: name.key:value
-                    value = ''.join(line.split(':')[1])[:-1].strip() # remove \n with a function
-                    setattr(self, '_%s_%s' % (key, lang), value) 
+    def value(self, key, lang, fallback=True):
+        """translated info about the image, from other languages if it's missing"""
+        values = self.catalog.entries.get(self.name, {}).get(key, {})
+        if lang in values:
+            return values[lang]
+        if fallback:
+            for other in LANGUAGES:
+                if other in values:
+                    return values[other]
+        return None
 
     def save(self):
         # save to build/static/img
         global BUILD_DIR
-        try:
-            os.makedirs(os.path.join(BUILD_DIR, 'static', 'img'))
-        except:
-            pass
-        #self.image.save(self.build_path)
-        open(self.build_path, 'w').write(self.image_raw)
-        
+        build_path = os.path.join(ensure_dir(os.path.join(BUILD_DIR, 'static', 'img')), self.filename)
+        if build_path in MANIFEST.built:
+            return # an image with the same name in another language
+        if not same_file(self.path, build_path):
+            link_or_copy(self.path, build_path)
+            PROFILE.written(os.path.getsize(build_path))
+        MANIFEST.track(build_path, [self.path])
+        if FINGERPRINTS is not None:
+            fingerprint(build_path, MANIFEST.signature(self.path)[2])
+
+    def variants(self):
+        """(filename, width, PIL format) of the optimized copies of the image (see optimize_images)"""
+        if not IMAGE_OPTIONS or self.format not in ('JPEG', 'PNG'):
+            return []
+        base, extension = os.path.splitext(self.filename)
+        widths = sorted(set([x for x in IMAGE_OPTIONS['widths'] if x < self.width])) + [self.width]
+        result = []
+        for width in widths:
+            name = width == self.width and base or '%s-%i' % (base, width)
+            result.append((name + extension, width, self.format))
+            if IMAGE_OPTIONS['webp']:
+                result.append(('%s.webp' % name, width, 'WEBP'))
+        return result
+
     def get(self, cl='', id=''):
+        url = self.url()
+        variants = self.variants()
+        prefix = url[:-len(asset_url(self._url))]
+        srcset = lambda format: ', '.join(['%s%s %iw' % (prefix, asset_url('static/img/' + filename), width)
+            for filename, width, f in variants if f == format])
         res = '<img '
         if cl:
             res += 'class="%s" ' % cl
         if id:
             res += 'id="%s" '% id
-        res += 'src="%s" title="%s" alt="%s"/>' % (self.url(), self.title, self.alt)
+        if variants:
+            res += 'srcset="%s" sizes="%s" ' % (srcset(self.format), IMAGE_OPTIONS['sizes'])
+        res += 'src="%s" title="%s" alt="%s"/>' % (url, self.title, self.alt)
+        if variants and IMAGE_OPTIONS['webp']:
+            res = '<picture><source type="image/webp" srcset="%s" sizes="%s"/>%s</picture>' % (
+                srcset('WEBP'), IMAGE_OPTIONS['sizes'], res)
         return res
 
     def __str__(self):
@@ -336,12 +1056,148 @@ class Img:
     def __getattr__(self, field):
         """ return values from object using page language """
         global PAGE
-        try:
-            result = self.__dict__['_%s_%s' % (field, PAGE.lang)]
-        except:
+        if field.startswith('__') or field == 'catalog': # python internals (copy, pickle, ...)
+            raise AttributeError(field)
+        result = self.value(field, PAGE and PAGE.lang)
+        if result is None:
+            # images in a catalog are expected to have all their fields
+            if self.name in self.catalog.entries and (self.path, field) not in MISSING:
+                MISSING.add((self.path, field))
+                print "Warning: no '%s' for %s in any catalog." % (field, self.filename)
             result = ''
         return result
 
+
+def encode_image(task):
+    """write a resized and recompressed copy of an image (runs in worker processes)"""
+    source, width, format, quality, target = task
+    image = Image.open(source)
+    if image.mode == 'P':
+        image = image.convert('RGBA')
+    if width < image.size[0]:
+        height = max(1, int(round(image.size[1] * float(width) / image.size[0])))
+        image = image.resize((width, height), getattr(Image, THUMBNAIL_RESAMPLE))
+    options = {}
+    if format == 'JPEG':
+        if image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        options = {'quality': quality, 'optimize': True, 'progressive': True}
+    elif format == 'PNG':
+        options = {'optimize': True}
+    elif format == 'WEBP':
+        options = {'quality': quality, 'method': 4}
+    # write and rename, a cached copy is never seen half written
+    tmp_path = '%s.%i.tmp' % (target, os.getpid())
+    image.save(tmp_path, format, **options)
+    os.rename(tmp_path, target)
+    return target
+
+def optimize_images(images, jobs=1):
+    """save images and their variants (other widths, webp) to build/static/img
+
+    Variants are named after the source content, width, format and quality
+    and kept between builds in cache_path('images') while an image uses them;
+    missing ones are encoded in a pool of worker processes if jobs > 1. The recompressed copy of an image is
+    only used when it is smaller than the original.
+    """
+    quality = IMAGE_OPTIONS['quality']
+    cache_dir = cache_path('images')
+    build_dir = ensure_dir(os.path.join(BUILD_DIR, 'static', 'img'))
+    links = []
+    tasks = {}
+    for img in images:
+        variants = img.variants()
+        if not variants:
+            img.save()
+            continue
+        digest = MANIFEST.signature(img.path)[2]
+        for filename, width, format in variants:
+            key = '%s:%s:%i:%i:%s' % (digest, format, width, quality, THUMBNAIL_RESAMPLE)
+            cached = os.path.join(cache_dir, '%s.%s' % (hashlib.md5(key).hexdigest(), filename.split('.')[-1].lower()))
+            hit = os.path.exists(cached)
+            PROFILE.hit('images', hit)
+            if not hit:
+                tasks[cached] = (img.path, width, format, quality, cached)
+            links.append((img, filename, cached))
+
+    if tasks:
+        with PROFILE.phase('image encoding'):
+            if jobs > 1 and len(tasks) > 1:
+                pool = multiprocessing.Pool(min(jobs, len(tasks)))
+                try:
+                    pool.map(encode_image, tasks.values())
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                for task in tasks.values():
+                    encode_image(task)
+
+    for img, filename, cached in links:
+        path = os.path.join(build_dir, filename)
+        if path in MANIFEST.built:
+            continue # an image with the same name in another language
+        digest = os.path.basename(cached).split('.')[0]
+        if filename == img.filename and os.path.getsize(cached) >= os.path.getsize(img.path):
+            cached = img.path
+            digest = MANIFEST.signature(img.path)[2]
+        if not same_file(cached, path):
+            link_or_copy(cached, path)
+            PROFILE.written(os.path.getsize(path))
+        MANIFEST.track(path, [img.path])
+        if FINGERPRINTS is not None:
+            fingerprint(path, digest)
+    # variants of images which changed or are gone
+    prune_cache('images', [os.path.basename(x[2]).split('.')[0] for x in links])
+
+
+class Catalog:
+    """Translated info of the images in a directory, from its catalog.<lang> files.
+
+    entries is indexed by image name, then key, then language. Catalogs are
+    read once per directory (see get) and kept between builds in CATALOG_CACHE
+    while their files don't change.
+    """
+    def __init__(self, dirname):
+        self.dirname = dirname
+        self.entries = {}
+        for lang in LANGUAGES:
+            path = os.path.join(dirname, 'catalog.%s' % lang)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            cached = CATALOG_CACHE is not None and CATALOG_CACHE.get(path)
+            if cached and cached[0] == (st.st_mtime, st.st_size):
+                lines = cached[1]
+            else:
+                lines = self.parse(path)
+                if CATALOG_CACHE is not None:
+                    CATALOG_CACHE.set(path, ((st.st_mtime, st.st_size), lines))
+            for name, key, value in lines:
+                self.entries.setdefault(name, {}).setdefault(key, {})[lang] = value
+
+    @staticmethod
+    def get(dirname):
+        """catalog of dirname, shared by all its images"""
+        if dirname not in CATALOGS:
+            with PROFILE.phase('catalogs'):
+                CATALOGS[dirname] = Catalog(dirname)
+        return CATALOGS[dirname]
+
+    def parse(self, path):
+        """(name, key, value) from lines with format name.key:value"""
+        lines = []
+        for line in codecs.open(path, 'r', 'utf-8'):
+            if ':' not in line:
+                continue
+            field, value = line.split(':', 1)
+            if '.' not in field:
+                continue
+            name, key = field.rsplit('.', 1)
+            lines.append((name.strip().lower(), key.strip(), value.strip()))
+        return lines
+
 #TODO: remove this class and use Item class too
 class Gallery:
     """Image container"""
@@ -359,116 +1215,1156 @@ class Gallery:
 
 
 class Box:
-    """Basic Box object"""
-    def __init__(self, filename):
+    """Basic Box object, read when it's created unless lazy is True"""
+    def __init__(self, filename, lazy=False):
         self.filename = filename
-        try:
-            self.lines = codecs.open(filename, "r", "utf-8").readlines()
-        except UnicodeDecodeError:
-            print 'Please, use UTF-8 in %s' % filename
-            sys.exit(1)
+        self.clear()
+        if not lazy:
+            self.load()
+
+    def clear(self):
+        self.header = [] # header lines split by ':'
         self.md = ""
         self.html = ""
-
-        self.parse()
+        self.output = ""
+        self.template_name = None
 
     def __str__(self):
-        return self.html or self.md or "Empty, please fill it"
-
-    def get_html(self):
-        self.html = md.convert(self.md)
+        if self.template_name and SINGLE_RENDER:
+            return self.output # rendered, maybe to an empty string
+        return self.output or self.html or self.md or "Empty, please fill it"
+
+    def render(self, context):
+        """render jinja2 code found in html with the page context"""
+        if self.template_name:
+            with PROFILE.phase('box templates'):
+                self.output = ENV.get_template(self.template_name).render(context)
+        return self.output
+
+    def load(self):
+        """parse the file, or take header, markdown and html from CONTENT_CACHE
+
+        Entries are keyed by file content and markdown extensions, so
+        unchanged files aren't read again between builds.
+        """
+        key = None
+        if CONTENT_CACHE is not None:
+            key = '%s:%s' % (MANIFEST.signature(self.filename)[2], ','.join(MARKDOWN_EXTENSIONS))
+            content = CONTENT_CACHE.get(key)
+            if content is not None:
+                self.header, self.md, self.html = content
+        if key is None or content is None:
+            try:
+                lines = codecs.open(self.filename, "r", "utf-8").readlines()
+            except UnicodeDecodeError:
+                print 'Please, use UTF-8 in %s' % self.filename
+                sys.exit(1)
+            self.parse(lines)
+            self.set_attributes()
+            if PENDING_BOXES is not None:
+                PENDING_BOXES.append((self, key)) # see convert_boxes()
+                return
+            self.get_html()
+            if key is not None:
+                CONTENT_CACHE.set(key, (self.header, self.md, self.html))
+        else:
+            self.set_attributes()
+        self.set_template()
+
+    def read_header(self):
+        """header of the file without its markdown (for boxes not loaded yet, see parse)"""
+        header = []
+        for line in codecs.open(self.filename, "r", "utf-8"):
+            if not ':' in line:
+                break
+            header.append(clean_line(line).split(":"))
+        return header
 
-        # insert newline after header tags
-        #for i in ('h1', 'h2', 'h3', 'h4', 'h5', 'h6'):
-        #    self.html = self.html.replace('</%s>' % i, '</%s><br>' % i)
+    def unload(self):
+        """forget what load() read, attributes from the header included"""
+        for data in self.header:
+            self.__dict__.pop(data[0], None)
+        BOX_SOURCES.pop(self.template_name, None)
+        self.clear()
 
-        # add bootstrap styles to tables
-        self.html = self.html.replace('<table>', '<table class="table table-striped">')
+    def get_html(self):
+        with PROFILE.phase('markdown'):
+            self.html = markdown_to_html(self.md)
+
+    def set_template(self):
+        """register html as a template (compiled once by content) if it has jinja2 code"""
+        if '{{' in self.html or '{%' in self.html:
+            self.template_name = 'box:%s' % hashlib.md5(self.html.encode('utf-8')).hexdigest()
+            BOX_SOURCES[self.template_name] = self.html
+
+    def set_attributes(self):
+        """add header values as attributes of this object"""
+        for data in self.header:
+            attr = data[0]
+            value = data[1].strip('\r\n')
+            # TODO: use symbol '#' to mark expresions to evaluate
+            #try:
+                # to eval a string is cool! (maths are welcome)
+                #value = eval(data)
+            #except:
+            #value = data
+            #    if t: print "+++", attr, value
+            try:
+                setattr(self, attr, value)
+            except:
+                print 'Error reading file %s. Please, review that file.' % self.filename
+                sys.exit(1)
 
-    def parse(self):
-        """Parse a page object in order to set attributes from its header"""
-        # read attributes until empty line or not key-value pair
+    def parse(self, lines):
+        """Split a file into header (attributes until a line without ':') and markdown"""
         is_header = True
-        for line in self.lines:
+        md_lines = []
+        for line in lines:
             # check for attributes at first line
             if is_header and not ':' in line:
                 is_header = False
             # add line to markdown if it isn't header
             if not is_header:
-                self.md += line + '\n'
+                md_lines.append(line + '\n')
             else:
-                # empty line to split header from body
-                if is_header and line == "":
-                    self.md += '\n'
-                    continue
-                data = clean_line(line).split(":")
+                self.header.append(clean_line(line).split(":"))
+        self.md = ''.join(md_lines)
+
+class Cache:
+    """Persistent dictionary kept as a pickle file in CACHE_DIR.
+
+    Entries not used during a build are dropped when it is saved (unless
+    prune is False: builds that take the site model from its cache don't
+    look at most entries).
+    """
+    def __init__(self, name, directory=None):
+        self.name = name
+        self.path = os.path.join(directory or CACHE_DIR, '%s.pickle' % name)
+        self.data = {}
+        self.used = set()
+        if os.path.exists(self.path):
+            try:
+                self.data = pickle.load(open(self.path, 'rb'))
+            except Exception:
+                print "Warning: ignoring broken cache %s." % self.path
+
+    def get(self, key):
+        PROFILE.hit(self.name, key in self.data)
+        if key in self.data:
+            self.used.add(key)
+            return self.data[key]
+        return None
+
+    def set(self, key, value):
+        self.data[key] = value
+        self.used.add(key)
+
+    def save(self, prune=True):
+        if prune:
+            for key in set(self.data) - self.used:
+                del self.data[key]
+        ensure_dir(os.path.dirname(self.path))
+        f = open(self.path, 'wb')
+        pickle.dump(self.data, f, pickle.HIGHEST_PROTOCOL)
+        f.close()
+
+
+def shared_cache(name):
+    """Cache(name), or the one in SHARED_CACHE_DIR, loaded once for every
+    project built by this process (its keys must not depend on the project)"""
+    if SHARED_CACHE_DIR is None:
+        return Cache(name)
+    if name not in SHARED_CACHES:
+        SHARED_CACHES[name] = Cache(name, SHARED_CACHE_DIR)
+    return SHARED_CACHES[name]
+
+
+class SharedBytecodeCache(FileSystemBytecodeCache):
+    """jinja2 bytecode keyed by template name and source (not by filename),
+    so projects with the same templates use the same compiled code"""
+    def get_bucket(self, environment, name, filename, source):
+        checksum = self.get_source_checksum(source)
+        bucket = Bucket(environment, self.get_cache_key('%s|%s' % (name, checksum)), checksum)
+        self.load_bytecode(bucket)
+        return bucket
+
+
+class Manifest:
+    """Persistent record of every output file and the sources it was built from.
+
+    Each output keeps a signature (mtime, size, md5) of its dependencies, so
+    the next build only regenerates outputs with a changed dependency.
+    `sources` are the files an output is made from: when one of them vanishes
+    the output is deleted. `deps` only make it stale (templates, config, ...).
+    Signatures of deps are kept in groups shared by the outputs built with
+    the same ones (every page depends on the same site files). Deps named
+    EXISTS_DEP + path only make outputs stale when path appears or vanishes.
+    """
+    def __init__(self, path, force=False):
+        self.path = path
+        self.force = force
+        self.outputs = {}
+        self.groups = {} # key -> {path: signature}
+        self.signatures = {}
+        self.built = set()
+        if os.path.exists(path) and not force:
+            try:
+                state = pickle.load(open(path, 'rb'))
+                self.outputs, self.groups = state['outputs'], state['groups']
+            except Exception:
+                print "Warning: ignoring broken manifest %s." % path
+        # last known signature of every dependency
+        self.known = {}
+        for group in self.groups.values():
+            self.known.update(group)
+        for record in self.outputs.values():
+            self.known.update(record['deps'])
+        self.fresh_groups = {} # group key -> True if no dep changed
+        self.group_keys = {} # tuple of deps -> group key of their current signatures
+        self.stale_count = 0
+        self.fresh_count = 0
+        self.journal = []
+
+    def signature(self, path):
+        """(mtime, size, md5) of a file, hashing it only when mtime or size moved"""
+        if path in self.signatures:
+            return self.signatures[path]
+        if path.startswith(EXISTS_DEP):
+            sig = os.path.exists(path[len(EXISTS_DEP):]) and (0, 0, 'exists') or None
+            self.signatures[path] = sig
+            return sig
+        try:
+            st = os.stat(path)
+        except OSError:
+            sig = None
+        else:
+            sig = self.known.get(path)
+            if not sig or sig[:2] != (st.st_mtime, st.st_size):
+                sig = (st.st_mtime, st.st_size, file_hash(path))
+        self.signatures[path] = sig
+        return sig
+
+    def changed(self, signatures):
+        """True if a file in signatures ({path: signature}) changed"""
+        for path, old in signatures.items():
+            new = self.signature(path)
+            if new is None or new[2] != old[2]:
+                return True
+            signatures[path] = new # only mtime changed
+        return False
+
+    def is_stale(self, output, sources, deps=()):
+        """True if output must be (re)built from sources and deps"""
+        record = self.outputs.get(output)
+        group = record and self.groups.get(record['group'])
+        stale = (self.force or record is None or not os.path.exists(output)
+            or set(record['deps']) != set(sources)
+            or (group is None and bool(deps)) or (group is not None and set(group) != set(deps)))
+        if not stale and group:
+            if record['group'] not in self.fresh_groups:
+                self.fresh_groups[record['group']] = not self.changed(group)
+            stale = not self.fresh_groups[record['group']]
+        if not stale:
+            stale = self.changed(record['deps'])
+        if stale:
+            self.stale_count += 1
+        else:
+            self.fresh_count += 1
+            self.built.add(output)
+        return stale
+
+    def group(self, deps):
+        """key of the group with the current signatures of deps"""
+        deps = tuple(deps)
+        if deps not in self.group_keys:
+            signatures = dict((path, self.signature(path)) for path in deps)
+            key = hashlib.md5(repr(sorted(signatures.items()))).hexdigest()
+            self.groups.setdefault(key, signatures)
+            self.fresh_groups[key] = True
+            self.group_keys[deps] = key
+        return self.group_keys[deps]
+
+    def record(self, output, sources, deps=()):
+        """remember that output has been built from sources and deps"""
+        self.outputs[output] = {
+            'sources': list(sources),
+            'deps': dict((path, self.signature(path)) for path in sources),
+            'group': deps and self.group(deps) or None,
+        }
+        self.built.add(output)
+        self.journal.append((output, sources, deps))
+
+    def track(self, output, sources):
+        """remember an output copied from sources, without signatures (see same_file)"""
+        self.outputs[output] = {'sources': list(sources), 'deps': {}, 'group': None}
+        self.built.add(output)
+
+    def clean(self):
+        """delete outputs whose sources vanished, the ones made from them
+        (.gz and .br siblings) and the directories left empty"""
+        removed = set()
+        for output, record in self.outputs.items():
+            if output in self.built:
+                continue
+            if [x for x in record['sources'] if not os.path.exists(x)]:
+                removed.add(output)
+        for output, record in self.outputs.items():
+            if removed.intersection(record['sources']):
+                removed.add(output)
+        for output in removed:
+            if os.path.exists(output):
+                os.remove(output)
+                print "%s removed." % output
+                remove_empty_dirs(os.path.dirname(output))
+            del self.outputs[output]
+
+    def refresh(self):
+        """forget signatures computed so far, files may have changed since"""
+        self.signatures = {}
+        self.fresh_groups = {}
+        self.group_keys = {}
 
-                # end of header
-                if len(data) == 0:
-                    is_header = False
-                    self.md += line + ' '
+    def save(self):
+        used = set([record['group'] for record in self.outputs.values()])
+        groups = dict((key, value) for key, value in self.groups.items() if key in used)
+        ensure_dir(os.path.dirname(self.path))
+        f = open(self.path, 'wb')
+        pickle.dump({'outputs': self.outputs, 'groups': groups}, f, pickle.HIGHEST_PROTOCOL)
+        f.close()
+
+
+def sync_tree(src, dst, threads=COPY_THREADS):
+    """copy new and changed files from src to dst, in a pool of threads
+
+    Unchanged files are left alone, so a full build doesn't copy the whole
+    tree again. Files are hardlinked when possible (see link_or_copy), from
+    their copy by content in SHARED_CACHE_DIR if there is one.
+    """
+    synced = []
+    copies = []
+    for root, dirs, files in os.walk(src):
+        for name in files:
+            path = os.path.join(root, name)
+            target = os.path.join(dst, os.path.relpath(path, src))
+            if not same_file(path, target) and not processed_copy(path, target):
+                ensure_dir(os.path.dirname(target))
+                copies.append((path, target))
+            MANIFEST.track(target, [path])
+            synced.append((path, target))
+    if len(copies) > 1 and threads > 1:
+        pool = ThreadPool(min(threads, len(copies)))
+        try:
+            pool.map(lambda x: copy_static(*x), copies)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for path, target in copies:
+            copy_static(path, target)
+    for path, target in copies:
+        PROFILE.written(os.path.getsize(target))
+    if FINGERPRINTS is not None:
+        for path, target in synced:
+            if path.endswith('.css'):
+                continue # see fingerprint_css()
+            if get_type(os.path.basename(path))[0] in FINGERPRINT_TYPES:
+                fingerprint(target, MANIFEST.signature(path)[2])
+    return len(copies)
+
+
+def copy_static(src, dst):
+    """link_or_copy() a static file, through the shared store if there is one"""
+    if SHARED_CACHE_DIR:
+        src = store_static(src)
+    link_or_copy(src, dst)
+
+
+def build_url(path):
+    """url of a file in BUILD_DIR, relative to it"""
+    return '/'.join(os.path.relpath(path, BUILD_DIR).split(os.path.sep))
+
+def asset_url(url):
+    """url of an asset with its hash when fingerprinting (see fingerprint)"""
+    if FINGERPRINTS:
+        return FINGERPRINTS.get(url, url)
+    return url
+
+def fingerprint(path, digest):
+    """hardlink an output as name.<hash>.ext, assets are linked with that url"""
+    base, extension = os.path.splitext(path)
+    hashed = '%s.%s%s' % (base, digest[:10], extension)
+    if not same_file(path, hashed):
+        link_or_copy(path, hashed)
+    MANIFEST.track(hashed, MANIFEST.outputs[path]['sources'])
+    FINGERPRINTS[build_url(path)] = build_url(hashed)
+
+def fingerprint_css(src, dst):
+    """write name.<hash>.css copies of the stylesheets in src, with their url()
+    references to other assets fingerprinted too (once the rest are done)"""
+    for root, dirs, files in os.walk(src):
+        for name in [x for x in files if x.endswith('.css')]:
+            path = os.path.join(root, name)
+            target = os.path.join(dst, os.path.relpath(path, src))
+            directory = posixpath.dirname(build_url(target))
+
+            def replace(match):
+                quote, ref = match.groups()
+                clean = ref.split('?')[0].split('#')[0]
+                if ':' in clean or clean.startswith('/') or not clean:
+                    return match.group(0) # data:, http:, absolute urls
+                hashed = FINGERPRINTS.get(posixpath.normpath(posixpath.join(directory, clean)))
+                if not hashed:
+                    return match.group(0)
+                return 'url(%s%s%s%s)' % (quote, posixpath.relpath(hashed, directory), ref[len(clean):], quote)
+
+            css = CSS_URL_RE.sub(replace, open(path, 'rb').read())
+            base, extension = os.path.splitext(target)
+            hashed = '%s.%s%s' % (base, hashlib.md5(css).hexdigest()[:10], extension)
+            if not os.path.exists(hashed):
+                write_output(hashed, css)
+            MANIFEST.track(hashed, [path])
+            FINGERPRINTS[build_url(target)] = build_url(hashed)
+
+def save_fingerprints():
+    """write the urls of fingerprinted assets to BUILD_DIR/fingerprints.json"""
+    write_output(os.path.join(BUILD_DIR, 'fingerprints.json'), json.dumps(FINGERPRINTS, indent=1, sort_keys=True))
+
+
+def processed_copy(src, dst):
+    """True if dst is the minified copy of src as it is now (see post_process)"""
+    entry = POST_PROCESS and OUTPUT_CACHE.data.get(dst)
+    return bool(entry) and entry[1:] == (file_signature(src), POST_PROCESS) and os.path.exists(dst)
+
+
+def remove_empty_dirs(directory):
+    """delete directory and its parents up to BUILD_DIR while they are empty"""
+    build_dir = os.path.abspath(BUILD_DIR)
+    directory = os.path.abspath(directory)
+    while directory.startswith(build_dir + os.path.sep) and not os.listdir(directory):
+        os.rmdir(directory)
+        directory = os.path.dirname(directory)
+
+def remove_orphans(directory):
+    """delete files under directory which aren't outputs of the build (and empty dirs)"""
+    for root, dirs, files in os.walk(directory, topdown=False):
+        for name in files:
+            path = os.path.join(root, name)
+            if path not in MANIFEST.outputs:
+                os.remove(path)
+                print "%s removed." % path
+        if root != directory and not os.listdir(root):
+            os.rmdir(root)
+
+
+def _minify_html(match):
+    if match.group(1): # pre, textarea, script and style are kept as they are
+        return match.group(1)
+    if match.group(3): # comments, but not conditional ones
+        return ''
+    return '\n' in match.group(4) and '\n' or ' '
+
+def minify_html(html):
+    """collapse whitespace and drop comments of an html page"""
+    return HTML_MINIFY_RE.sub(_minify_html, html)
+
+def minify_css(css):
+    """drop comments (but /*! ones) and whitespace of a stylesheet"""
+    css = CSS_COMMENT_RE.sub('', css)
+    css = re.sub(r'\s+', ' ', css)
+    css = re.sub(r' ?([{};,>]) ?', r'\1', css)
+    return css.replace(';}', '}').strip()
+
+def processed_key(content, minify, compress):
+    """name of the processed copy of content in CACHE_DIR/outputs"""
+    return hashlib.md5('%s:%s:%s' % (hashlib.md5(content).hexdigest(), minify, compress)).hexdigest()
+
+def processed_output(path, content):
+    """True if path still is the processed copy of content (with POST_PROCESS)"""
+    entry = POST_PROCESS and OUTPUT_CACHE is not None and OUTPUT_CACHE.data.get(path)
+    if not entry or entry[2] != POST_PROCESS or entry[0] != processed_key(content, *POST_PROCESS):
+        return False
+    base = os.path.join(CACHE_DIR, 'outputs', entry[0])
+    return os.path.exists(path) and os.path.exists(base) and os.path.samefile(path, base)
+
+def post_process_file(task):
+    """minify and compress an output into the cache (runs in worker processes)
+
+    Results are named after the content and options, returns that name.
+    """
+    path, minify, compress, cache_dir = task
+    content = open(path, 'rb').read()
+    key = processed_key(content, minify, compress)
+    base = os.path.join(cache_dir, key)
+    if os.path.exists(base):
+        return path, key
+    extension = path.split('.')[-1].lower()
+    if minify:
+        if extension == 'html':
+            content = minify_html(content)
+        elif extension == 'css':
+            content = minify_css(content)
+        elif extension == 'js' and jsmin:
+            content = jsmin(content.decode('utf-8')).encode('utf-8')
+    results = []
+    if compress:
+        buf = StringIO()
+        gz = gzip.GzipFile(filename='', mode='wb', fileobj=buf, compresslevel=9, mtime=0)
+        gz.write(content)
+        gz.close()
+        results.append(('.gz', buf.getvalue()))
+        if brotli:
+            results.append(('.br', brotli.compress(content)))
+    results.append(('', content)) # the last one, its existence means it is done
+    for suffix, data in results:
+        tmp = '%s%s.%i.tmp' % (base, suffix, os.getpid())
+        f = open(tmp, 'wb')
+        f.write(data)
+        f.close()
+        os.rename(tmp, base + suffix)
+    return path, key
+
+def post_process(jobs=1):
+    """minify outputs and write their .gz (and .br) siblings (MINIFY and COMPRESS in config.yml)
+
+    Outputs are hardlinked to their processed copy in CACHE_DIR/outputs, so
+    files which are still that copy are skipped without reading them, and
+    the rest are processed in a pool of worker processes if jobs > 1.
+    """
+    minify, compress = POST_PROCESS
+    cache = OUTPUT_CACHE
+    cache_dir = ensure_dir(os.path.join(CACHE_DIR, 'outputs'))
+    suffixes = compress and (brotli and ['.gz', '.br'] or ['.gz']) or []
+    tasks = []
+    for root, dirs, files in os.walk(BUILD_DIR):
+        if root == BUILD_DIR:
+            dirs[:] = [x for x in dirs if x != '.cache']
+        for name in files:
+            if name.split('.')[-1].lower() not in COMPRESS_EXTENSIONS:
+                continue
+            path = os.path.join(root, name)
+            entry = cache.get(path)
+            if entry and entry[2] == POST_PROCESS:
+                base = os.path.join(cache_dir, entry[0])
+                linked = [x for x in [''] + suffixes
+                    if os.path.exists(path + x) and os.path.exists(base + x)
+                    and os.path.samefile(path + x, base + x)]
+                if len(linked) == len(suffixes) + 1:
+                    for suffix in suffixes:
+                        MANIFEST.track(path + suffix, [path])
                     continue
+            tasks.append((path, minify, compress, cache_dir))
+
+    if jobs > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(min(jobs, len(tasks)))
+        try:
+            results = pool.map(post_process_file, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [post_process_file(task) for task in tasks]
+
+    for path, key in results:
+        # static files are copies, see processed_copy()
+        record = MANIFEST.outputs.get(path)
+        origin = record and record['sources'] and file_signature(record['sources'][0])
+        base = os.path.join(cache_dir, key)
+        for suffix in [''] + suffixes:
+            if not (os.path.exists(path + suffix) and os.path.samefile(base + suffix, path + suffix)):
+                link_or_copy(base + suffix, path + suffix)
+                PROFILE.written(os.path.getsize(path + suffix))
+            if suffix:
+                MANIFEST.track(path + suffix, [path])
+        cache.set(path, (key, origin, POST_PROCESS))
+    return len(tasks)
+
+def save_output_cache():
+    """save OUTPUT_CACHE and delete the processed copies no entry uses any more"""
+    OUTPUT_CACHE.save()
+    directory = os.path.join(CACHE_DIR, 'outputs')
+    if os.path.isdir(directory):
+        prune_files(directory, set([entry[0] for entry in OUTPUT_CACHE.data.values()]))
+
+def remove_compressed():
+    """delete .gz and .br siblings written by builds with COMPRESS"""
+    for path, entry in OUTPUT_CACHE.data.items():
+        if entry[2][1]:
+            for suffix in ['.gz', '.br']:
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+                    print "%s removed." % (path + suffix)
+
+
+class Site:
+    """Project model: settings plus the item tree and galleries of every language.
+
+    Resources are discovered once per language and the same tree is used for
+    menus and pages, so build() and other tools (dev server, link checker...)
+    can load a project a single time and share it.
+    """
+    def __init__(self, project_path):
+        self.path = project_path
+        self.build_dir = os.path.join(project_path, 'build')
+        self.resources_dir = os.path.join(project_path, 'resources')
+        self.static_dir = os.path.join(self.resources_dir, 'static')
+        self.templates_dir = os.path.join(project_path, 'templates')
+        self.config_path = os.path.join(project_path, 'config.yml')
+        self.model_path = os.path.join(self.build_dir, '.cache', 'site.pickle')
+        self.restored = False
+
+        # read settings file (yaml format) - config.yml
+        self.settings = self.read_settings()
+
+        # assing data from settings to LANGUAGE and I18N
+        self.languages = self.settings['LANGUAGES']
+        self.i18n = self.settings['I18N']
+        self.builtins = {}
+        self.menu = {}
+        self.pages = {} # language -> page id -> Item
+        self.translations = {} # page id -> language -> Item
+        self.gallery = {}
+        self.static = None
+        self.site_deps = []
+
+    def read_settings(self):
+        """settings from config.yml, kept with the model while the file doesn't change"""
+        try:
+            st = os.stat(self.config_path)
+        except OSError:
+            print "Error: create a config.yml file with project settings. __init__.py is deprecated."
+            sys.exit(2)
+        signature = (st.st_size, st.st_mtime)
+        path = os.path.join(os.path.dirname(self.model_path), 'settings.pickle')
+        try:
+            cached, settings = pickle.load(open(path, 'rb'))
+            if cached == signature:
+                return settings
+        except Exception:
+            pass
+        config = open(self.config_path)
+        settings = yaml.load(config)
+        config.close()
+        try:
+            ensure_dir(os.path.dirname(path))
+            pickle.dump((signature, settings), open(path, 'wb'), pickle.HIGHEST_PROTOCOL)
+        except (IOError, OSError):
+            pass
+        return settings
+
+    def load(self, jobs=1, cached=True):
+        """discover resources, one tree per language, and index pages by id
+        (in each language and across languages)
+
+        Markdown of new or changed boxes is converted after discovery, in a
+        pool of worker processes if jobs > 1. The model is saved to
+        build/.cache/site.pickle and, with cached=True, taken from there
+        while no file in resources/ (nor config.yml) changed.
+        In streaming builds (STREAM) only page.md files are read here, boxes
+        are loaded by render_page() and dropped once their page is written.
+        """
+        global LANGUAGES, GALLERY, MARKDOWN_EXTENSIONS, PENDING_BOXES
+        LANGUAGES = self.languages
+        MARKDOWN_EXTENSIONS = self.settings.get('MARKDOWN_EXTENSIONS', MARKDOWN_DEFAULT_EXTENSIONS)
+        CATALOGS.clear()
+        NAV_CACHE.clear()
+        snapshot = self.snapshot()
+        snapshot['stream'] = STREAM # boxes of a streaming model aren't loaded
+        self.restored = cached and self.restore(snapshot)
+        if self.restored:
+            GALLERY = self.gallery
+            return self
+        GALLERY = self.gallery
+        PENDING_BOXES = []
+        try:
+            self.discover()
+        finally:
+            boxes, PENDING_BOXES = PENDING_BOXES, None
+        convert_boxes(boxes, jobs)
+        self.save(snapshot)
+        return self
+
+    def snapshot(self):
+        """(size, mtime) of statica itself, config.yml and every file and directory in resources"""
+        snapshot = {}
+        for path in [SOURCE_PATH, self.config_path]:
+            st = os.stat(path)
+            snapshot[path] = (st.st_size, st.st_mtime)
+        for root, dirs, files in os.walk(self.resources_dir):
+            snapshot[root] = None
+            for name in files:
+                path = os.path.join(root, name)
+                st = os.stat(path)
+                snapshot[path] = (st.st_size, st.st_mtime)
+        return snapshot
+
+    def save(self, snapshot):
+        """pickle trees and indexes with the snapshot of the files they come from"""
+        state = dict(snapshot=snapshot, menu=self.menu, pages=self.pages,
+            translations=self.translations, gallery=self.gallery, static=self.static)
+        try:
+            ensure_dir(os.path.dirname(self.model_path))
+            tmp = '%s.%i.tmp' % (self.model_path, os.getpid())
+            f = open(tmp, 'wb')
+            try:
+                pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+            finally:
+                f.close()
+            os.rename(tmp, self.model_path)
+        except Exception, e: # values of page.md evaluated with '!' can't always be pickled
+            print "Warning: site model not cached (%s)." % e
+
+    def restore(self, snapshot):
+        """take trees and indexes from the saved model if snapshot didn't change"""
+        try:
+            f = open(self.model_path, 'rb')
+            try:
+                state = pickle.load(f)
+            finally:
+                f.close()
+        except Exception:
+            return False
+        if state['snapshot'] != snapshot:
+            return False
+        self.menu = state['menu']
+        self.pages = state['pages']
+        self.translations = state['translations']
+        self.gallery = state['gallery']
+        self.static = state['static']
+        for pages in self.pages.values():
+            for m in pages.values():
+                for box in m.boxes.values():
+                    box.set_template()
+        self.site_deps = self.deps()
+        return True
+
+    def discover(self):
+        """item trees and indexes of every language"""
+        # init an empty GALLERY object with language keys
+        for lang in self.languages:
+            GALLERY[lang] = {}
+        for lang in self.languages:
+            self.menu[lang] = Item(os.path.join(self.resources_dir, lang), lang=lang, level=0)
+            self.pages[lang] = walk(self.menu[lang], items={})
+        self.translations = {}
+        for lang in self.languages:
+            for id, m in self.pages[lang].items():
+                self.translations.setdefault(id, {})[lang] = m
+        self.static = Item(self.static_dir)
+        self.site_deps = self.deps()
+        return self
+
+    def images(self):
+        """every Img found in resources"""
+        items = [self.static] + self.menu.values()
+        while items:
+            item = items.pop()
+            items.extend(item.children)
+            for value in item.__dict__.values():
+                if isinstance(value, Img):
+                    yield value
+
+    def jinja_values(self):
+        """where values outside boxes have jinja2 code (page.md and box
+        headers, catalogs, I18N), not rendered with SINGLE_RENDER"""
+        places = []
+        def has_jinja(value):
+            return isinstance(value, basestring) and ('{{' in value or '{%' in value)
+        for lang in self.languages:
+            for id, m in sorted(self.pages[lang].items()):
+                for box in [m.box] + m.boxes.values():
+                    header = box.header or (STREAM and box.read_header()) or []
+                    places.extend(['%s (%s)' % (box.filename, data[0])
+                        for data in header if has_jinja(':'.join(data[1:]))])
+        catalogs = set([img.catalog for img in self.images()])
+        for catalog in sorted(catalogs, key=lambda x: x.dirname):
+            for name, keys in sorted(catalog.entries.items()):
+                for key, values in keys.items():
+                    places.extend(['%s/catalog.%s (%s.%s)' % (catalog.dirname, lang, name, key)
+                        for lang, value in values.items() if has_jinja(value)])
+        stack = [('I18N', self.i18n)]
+        while stack:
+            name, value = stack.pop()
+            if isinstance(value, dict):
+                stack.extend([('%s.%s' % (name, k), v) for k, v in value.items()])
+            elif has_jinja(value):
+                places.append('config.yml (%s)' % name)
+        return places
+
+    def deps(self):
+        """files every page depends on: settings, templates, menu entries,
+        catalogs, images and static files (css, js... only by name, unless
+        their urls change with their content)"""
+        deps = [self.config_path]
+        for root, dirs, files in os.walk(self.templates_dir):
+            deps.extend([join(root, f) for f in files])
+        prefix = not self.settings.get('FINGERPRINT') and EXISTS_DEP or ''
+        for root, dirs, files in os.walk(self.static_dir):
+            for f in files:
+                # titles and alts come from catalogs, thumbnail names and srcsets from images
+                if f.startswith('catalog.') or get_type(f)[0] == 'image':
+                    deps.append(join(root, f))
+                else:
+                    deps.append(prefix + join(root, f))
+        for lang in self.languages:
+            for root, dirs, files in os.walk(os.path.join(self.resources_dir, lang)):
+                for f in files:
+                    if f == 'page.md' or f.startswith('catalog.') or get_type(f)[0] == 'image':
+                        deps.append(join(root, f))
+        return deps
 
-                # add attribute to this object
-                attr = data[0]
-                value = data[1].strip('\r\n')
-                # TODO: use symbol '#' to mark expresions to evaluate
-                #try:
-                    # to eval a string is cool! (maths are welcome)
-                    #value = eval(data)
-                #except:
-                #value = data
-                #    if t: print "+++", attr, value
-                try:
-                    setattr(self, attr, value)
-                except:
-                    print 'Error reading file %s. Please, review that file.' % self.filename
-                    sys.exit(1)
-        self.get_html()
 
 def walk(item, items):
-    """return a dictionary with children from item"""
-    items = items
-    for i in item.children:
+    """return a dictionary with the descendants of item by id"""
+    stack = item.children[::-1]
+    while stack:
+        i = stack.pop()
         items[i.id] = i
-        if i.children:
-            walk(i, items)
+        stack.extend(i.children[::-1])
     return items
 
 
-def build(project_path):
-    """build project (main loop)"""
-    global LANGUAGES, BUILD_DIR, GALLERY, ENV
+def page_output(m):
+    """path to the html file of page m"""
+    return os.path.join(BUILD_DIR, m.lang, os.path.join(*m.root.split(os.path.sep)[-m.level:]), 'index.html')
+
+def page_sources(m):
+    """files read to render page m: page.md and its boxes"""
+    return [m.box.filename] + [box.filename for box in m.boxes.values()]
+
+def page_loc(site, m):
+    """absolute url of page m"""
+    return '%s/%s/%s/index.html' % (site.settings['DOMAIN'], m.lang, m._url)
+
+def sitemap_urls(site):
+    """<url> elements of every page, in a stable order"""
+    for lang in site.languages:
+        for id, m in sorted(site.pages[lang].items()):
+            mtime = max([MANIFEST.signature(x)[0] for x in page_sources(m)])
+            lastmod = date.fromtimestamp(mtime).isoformat()
+            lines = ['<url><loc>%s</loc><lastmod>%s</lastmod>' % (escape(page_loc(site, m)), lastmod)]
+            if getattr(m, 'changefreq', None):
+                lines.append('<changefreq>%s</changefreq>' % escape(m.changefreq))
+            if getattr(m, 'priority', None):
+                lines.append('<priority>%s</priority>' % escape(m.priority))
+            translations = site.translations[id]
+            if len(translations) > 1:
+                for l in site.languages:
+                    if l in translations:
+                        lines.append('<xhtml:link rel="alternate" hreflang="%s" href="%s"/>' % (
+                            l, escape(page_loc(site, translations[l]))))
+            lines.append('</url>\n')
+            yield lastmod, ''.join(lines)
+
+def sitemap_shards(urls, size):
+    """lists of up to size urls"""
+    shard = []
+    for url in urls:
+        shard.append(url)
+        if len(shard) == size:
+            yield shard
+            shard = []
+    if shard:
+        yield shard
+
+def write_sitemap(site):
+    """write sitemap.xml, an index of gzipped sitemap-<n>.xml.gz shards
+
+    A shard is only written again when its content changed, and lastmod of
+    each url is the newest mtime of the page sources.
+    """
+    cache = Cache('sitemap')
+    domain = site.settings['DOMAIN']
+    shard_size = site.settings.get('SITEMAP_SHARD_SIZE', SITEMAP_SHARD_SIZE)
+    head = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9" xmlns:xhtml="http://www.w3.org/1999/xhtml">\n')
+    index = ['<?xml version="1.0" encoding="UTF-8"?>\n',
+        '<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n']
+    n = 0
+    for n, shard in enumerate(sitemap_shards(sitemap_urls(site), shard_size), 1):
+        name = 'sitemap-%i.xml.gz' % n
+        path = os.path.join(BUILD_DIR, name)
+        xml = [x.encode('utf-8') for lastmod, x in shard]
+        digest = hashlib.md5(''.join(xml)).hexdigest()
+        if cache.get(name) != digest or not os.path.exists(path):
+            tmp = '%s.%i.tmp' % (path, os.getpid())
+            f = open(tmp, 'wb')
+            gz = gzip.GzipFile(filename='', mode='wb', fileobj=f, mtime=0)
+            gz.write(head)
+            for x in xml:
+                gz.write(x)
+            gz.write('</urlset>\n')
+            gz.close()
+            f.close()
+            os.rename(tmp, path)
+            PROFILE.written(os.path.getsize(path))
+        cache.set(name, digest)
+        index.append('<sitemap><loc>%s/%s</loc><lastmod>%s</lastmod></sitemap>\n' % (
+            escape(domain), name, max([lastmod for lastmod, x in shard])))
+    index.append('</sitemapindex>\n')
+    cache.save()
+
+    # shards left by a bigger site
+    n += 1
+    while os.path.exists(os.path.join(BUILD_DIR, 'sitemap-%i.xml.gz' % n)):
+        os.remove(os.path.join(BUILD_DIR, 'sitemap-%i.xml.gz' % n))
+        n += 1
+
+    write_output(os.path.join(BUILD_DIR, 'sitemap.xml'), ''.join(index))
+
+
+def stem(word, rules):
+    """word without the first suffix of rules it ends with (keeping SEARCH_MIN_STEM letters)"""
+    for suffix, replacement in rules:
+        if len(word) - len(suffix) >= SEARCH_MIN_STEM and word.endswith(suffix):
+            return word[:-len(suffix)] + replacement
+    return word
+
+def search_terms(text, lang):
+    """index terms of text: words without accents nor stopwords, stemmed (as SEARCH_SCRIPT does)"""
+    text = unicodedata.normalize('NFD', unicode(text).lower())
+    words = SEARCH_WORD_RE.split(SEARCH_MARKS_RE.sub(u'', text))
+    rules = SEARCH_STEMMERS.get(lang, [])
+    stopwords = SEARCH_STOPWORDS.get(lang, '').split()
+    return [stem(x, rules) for x in words if len(x) > 1 and x not in stopwords]
+
+def page_search(m):
+    """(document, term -> weight) of page m for the search index, taken from
+    the cache while its sources (and the stemmer) don't change"""
+    key = hashlib.md5(repr((m._url, SEARCH_STEMMERS.get(m.lang), SEARCH_STOPWORDS.get(m.lang),
+        [MANIFEST.signature(x)[2] for x in page_sources(m)]))).hexdigest()
+    cached = SEARCH_CACHE.get('%s/%s' % (m.lang, m.id))
+    if cached is not None and cached[0] == key:
+        return cached[1], cached[2]
+
+    title = unicode(getattr(m, 'title', '') or '')
+    description = unicode(getattr(m, 'description', '') or '')
+    texts = [(title, SEARCH_WEIGHTS['title']), (description, SEARCH_WEIGHTS['description'])]
+    for name, box in sorted(m.boxes.items()):
+        if STREAM:
+            box.load()
+        html = JINJA_TAG_RE.sub(u' ', box.html)
+        texts.append((HTML_PARSER.unescape(HTML_TAG_RE.sub(u' ', html)), SEARCH_WEIGHTS['text']))
+        if STREAM:
+            box.unload()
+    terms = {}
+    for text, weight in texts:
+        for term in search_terms(text, m.lang):
+            terms[term] = terms.get(term, 0) + weight
+    document = ['%s/%s/index.html' % (m.lang, m._url), title, description]
+    SEARCH_CACHE.set('%s/%s' % (m.lang, m.id), (key, document, terms))
+    return document, terms
+
+def write_search(site):
+    """write the search index of each language to build/search/<lang>/ and
+    its javascript client (SEARCH_SCRIPT) to build/search/search.js
+
+    index.json has the documents (url, title and description of pages) and
+    the rules to find terms in a query, <prefix>.json shards the postings
+    (document, weight...) of the terms starting with prefix, so a query only
+    downloads the shards of its terms. Terms of unchanged pages come from a
+    cache, and files are only written again when their content changes (see
+    write_output).
+    """
+    global SEARCH_CACHE
+    SEARCH_CACHE = Cache('search')
+    root = ensure_dir(os.path.join(BUILD_DIR, 'search'))
+    write_output(os.path.join(root, 'search.js'), SEARCH_SCRIPT)
+    for lang in site.languages:
+        documents = []
+        postings = {}
+        for id, m in sorted(site.pages[lang].items()):
+            document, terms = page_search(m)
+            for term, weight in terms.items():
+                postings.setdefault(term, []).extend([len(documents), weight])
+            documents.append(document)
+        shards = {}
+        for term, values in postings.items():
+            shards.setdefault(term[:SEARCH_PREFIX], {})[term] = values
+
+        directory = ensure_dir(os.path.join(root, lang))
+        meta = dict(docs=documents, shards=sorted(shards), prefix=SEARCH_PREFIX, min_stem=SEARCH_MIN_STEM,
+            rules=SEARCH_STEMMERS.get(lang, []), stopwords=SEARCH_STOPWORDS.get(lang, '').split())
+        write_output(os.path.join(directory, 'index.json'), json.dumps(meta, sort_keys=True, separators=(',', ':')))
+        for name, terms in shards.items():
+            write_output(os.path.join(directory, '%s.json' % name), json.dumps(terms, sort_keys=True, separators=(',', ':')))
+        # shards of terms that are gone, with their .gz and .br (see post_process)
+        for filename in os.listdir(directory):
+            name, ext = os.path.splitext(filename)
+            if ext == '.json' and name != 'index' and name not in shards:
+                for path in [filename, filename + '.gz', filename + '.br']:
+                    if os.path.exists(os.path.join(directory, path)):
+                        os.remove(os.path.join(directory, path))
+    for lang in os.listdir(root):
+        if lang not in site.languages and os.path.isdir(os.path.join(root, lang)):
+            shutil.rmtree(os.path.join(root, lang))
+    SEARCH_CACHE.save()
+
+
+def render_page(task):
+    """render and save a page, task is a (lang, page id) tuple
+
+    It only reads shared data from SITE (a loaded Site) so it can run in a
+    worker process.
+    Returns the outputs recorded into the manifest while rendering.
+    """
+    global PAGE
+    start = time.time()
+    lang, id = task
+    pages = SITE.pages
+    static = SITE.static
+    s = SITE.settings
+    m = pages[lang][id]
+    PAGE = m # only for objects printed without a jinja2 context (one page per process at a time)
+    MANIFEST.journal = []
+    if STREAM:
+        for box in m.boxes.values():
+            box.load()
+
+    try:
+        t = '%s.html' % m.template.strip() #template
+    except AttributeError:
+        print "Warning: Using default template for %s." % m
+        t = '%s.html' % s['DEFAULT_TEMPLATE']
+    t = ENV.get_template(t)
+
+    output_path = page_output(m)
+    output_dir = os.path.dirname(output_path)
+    boxes = dict(m.boxes)
+
+    lang_pages = SITE.translations[m.id]
+    if len(lang_pages) < len(LANGUAGES):
+        for l in LANGUAGES:
+            if l not in lang_pages:
+                print "Warning: missing info for '%s' language." % l
+
+    # write output file
+    boxes['current_language'] = m.lang
+    boxes['builtins'] = SITE.builtins
+    boxes['page'] = m #TODO: better not in boxes?
+    boxes['lang_pages'] = lang_pages
+    menu_lang = SITE.menu[lang].children
+    i18n = SITE.i18n[lang]
+
+    context = dict(css=static.css, js=static.js, img=static.img, ico=static.ico, menu=menu_lang, gallery=GALLERY[lang], i18n=i18n, **boxes)
+    if SINGLE_RENDER:
+        # boxes with jinja2 code are rendered on their own, the page just once
+        for box in m.boxes.values():
+            box.render(context)
+        with PROFILE.phase(t.name, PROFILE.templates):
+            output = t.render(context)
+        # add target to external links
+        output = output.replace('<a href="http:', '<a target=\'_blank\' href="http:')
+    else:
+        # render templates twice in order to use jinja2 into markdown files
+        with PROFILE.phase(t.name, PROFILE.templates):
+            output_md = t.render(context)
+        # add target to external links
+        output_md = output_md.replace('<a href="http:', '<a target=\'_blank\' href="http:')
+
+        with PROFILE.phase('second render'):
+            t_md = ENV.from_string(output_md)
+            output = t_md.render(context)
+
+    # save html file
+    if not os.path.isdir(output_dir):
+        try:
+            os.makedirs(output_dir)
+            print "directory %s created." % output_dir
+        except OSError:
+            pass # created by another worker
+    with PROFILE.phase('write'):
+        write_output(output_path, output)
+    MANIFEST.record(output_path, page_sources(m), SITE.site_deps)
+    if STREAM:
+        for box in m.boxes.values():
+            box.unload()
+        check_memory()
+    PROFILE.pages['%s/%s' % (lang, id)] = time.time() - start
+    return MANIFEST.journal
+
+
+def render_page_worker(task):
+    """render_page() in a worker process, it also returns the profile of the page"""
+    global PROFILE
+    PROFILE = Profile()
+    journal = render_page(task)
+    return journal, PROFILE.data()
+
+
+def render_pages(tasks, jobs=1):
+    """render (lang, page id) tasks, in a pool of worker processes if jobs > 1"""
+    # SITE is shared with render_page(), also in forked workers
+    if jobs > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(min(jobs, len(tasks)))
+        try:
+            # pages are rendered in workers, the manifest is written here
+            for journal, profile in pool.imap_unordered(render_page_worker, tasks):
+                for output, sources, deps in journal:
+                    MANIFEST.record(output, sources, deps)
+                PROFILE.merge(profile)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for task in tasks:
+            render_page(task)
+
+
+def build(project_path, incremental=False, jobs=1, profile=False, stream=False, max_memory=None):
+    """build project (main loop)
+
+    With incremental=True only outputs whose sources changed since the last
+    build are written again (see Manifest). With jobs > 1 pages are rendered
+    in a pool of worker processes. With profile=True a report of timings is
+    printed and saved to CACHE_DIR/profile.json. With stream=True boxes are
+    read, rendered and dropped one page at a time (without CONTENT_CACHE),
+    caches are freed when a process uses more than max_memory MB and the
+    peak memory is printed. Returns the loaded Site.
+    """
+    global BUILD_DIR, CACHE_DIR, MANIFEST, CONTENT_CACHE, CATALOG_CACHE, OUTPUT_CACHE, POST_PROCESS, FINGERPRINTS, IMAGE_OPTIONS, ENV, SITE, PROFILE, STREAM, MEMORY_LIMIT, MEMORY_CHECK, SINGLE_RENDER
 
     # initial constants
-    PROJECT_DIR = project_path
-    BUILD_DIR = os.path.join(PROJECT_DIR, 'build')
-    RESOURCES_DIR = os.path.join(PROJECT_DIR, 'resources')
-    STATIC_DIR = os.path.join(RESOURCES_DIR, 'static')
-    TEMPLATES_DIR = os.path.join(PROJECT_DIR, 'templates')
-    TEMPLATE_DEFAULT = 'main.html'
-
-    # initialize jinja2 objects
-    ENV = Environment(loader=FileSystemLoader(TEMPLATES_DIR))
+    PROFILE = Profile()
+    with PROFILE.phase('settings'):
+        site = Site(project_path)
+    BUILD_DIR = site.build_dir
+    CACHE_DIR = os.path.join(BUILD_DIR, '.cache')
+    s = site.settings
+
+    # initialize jinja2 objects (compiled templates are kept in CACHE_DIR/jinja)
+    loader = ChoiceLoader([FileSystemLoader(site.templates_dir), FunctionLoader(box_source)])
+    if SHARED_CACHE_DIR:
+        bytecode_cache = SharedBytecodeCache(cache_path('jinja'))
+    else:
+        bytecode_cache = FileSystemBytecodeCache(cache_path('jinja'))
+    ENV = Environment(loader=loader, bytecode_cache=bytecode_cache)
     ENV.filters['thumbnail'] = thumbnail
     ENV.filters['template'] = template
-
-    # read settings file (yaml format) - config.yml
-    try:
-        config = open('%s/config.yml' % PROJECT_DIR)
-    except:
-        print "Error: create a config.yml file with project settings. __init__.py is deprecated."
-        sys.exit(2)
-    s = yaml.load(config)
-    config.close()
-    
-    # assing data from settings to LANGUAGE and I18N
-    LANGUAGES = s['LANGUAGES']
-    I18N = s['I18N']
-
-    # init an empty GALLERY object with language keys
-    for lang in LANGUAGES:
-        GALLERY[lang] = {}
+    ENV.globals['navigation'] = navigation
+    ENV.globals['breadcrumb'] = breadcrumb
+    ENV.globals['siblings'] = siblings
+    ENV.globals['search_script'] = search_script
+
+    MANIFEST = Manifest(os.path.join(CACHE_DIR, 'manifest.pickle'), force=not incremental)
+    STREAM = stream
+    MEMORY_LIMIT = max_memory and max_memory << 20
+    MEMORY_CHECK = 0
+    SINGLE_RENDER = bool(s.get('SINGLE_RENDER'))
+    CONTENT_CACHE = not stream and shared_cache('content') or None
+    CATALOG_CACHE = Cache('catalogs')
+    OUTPUT_CACHE = Cache('outputs')
+    POST_PROCESS = None
+    if s.get('MINIFY') or s.get('COMPRESS'):
+        POST_PROCESS = (bool(s.get('MINIFY')), bool(s.get('COMPRESS')))
+    FINGERPRINTS = None
+    if s.get('FINGERPRINT'):
+        FINGERPRINTS = {}
+    IMAGE_OPTIONS = None
+    if s.get('IMAGES'):
+        IMAGE_OPTIONS = dict(IMAGE_DEFAULTS, **s['IMAGES'])
+        if IMAGE_OPTIONS['webp'] and not features.check('webp'):
+            print "Warning: PIL has no webp support, webp variants are disabled."
+            IMAGE_OPTIONS['webp'] = False
 
     #TODO: use external template for google_analytics
     google_analytics = Template("""<script type="text/javascript">
@@ -505,24 +2401,7 @@ def build(project_path):
       }
     </script>""")
 
-    #TODO: use external template for sitemap
-    sitemap_template = Template("""<?xml version="1.0" encoding="UTF-8"?>
-<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">
-  {% for url in urls %}
-  <url>
-    <loc>{{ url }}</loc>
-    <lastmod>{{ today }}</lastmod>
-    {% if page.changefreq %}
-    <changefreq>{{ page.changefreq }}</changefreq>
-    {% endif %}
-    {% if page.prority %}
-    <priority>{{ page.priority }}</priority>
-    {% endif %}
-  </url>
-  {% endfor %}
-</urlset> """)
-    
-    builtins = {}
+    builtins = site.builtins
 
     # built-ins
     try:
@@ -531,91 +2410,485 @@ def build(project_path):
     except:
         print "Warning! There aren't information to setup Google services."
 
-    # copy full static/ to build/static
-    try:
-        shutil.rmtree(os.path.join(BUILD_DIR, 'static'))
-    except:
+    # copy new and changed files of static/ to build/static
+    with PROFILE.phase('static sync'):
+        sync_tree(site.static_dir, os.path.join(BUILD_DIR, 'static'))
+
+    # get pages and menu (a single tree for each language)
+    with PROFILE.phase('discovery'):
+        site.load(jobs)
+    SITE = site
+    with PROFILE.phase('image copies'):
+        if IMAGE_OPTIONS:
+            optimize_images(site.images(), jobs)
+        else:
+            for img in site.images():
+                img.save()
+    if FINGERPRINTS is not None:
+        with PROFILE.phase('fingerprints'):
+            fingerprint_css(site.static_dir, os.path.join(BUILD_DIR, 'static'))
+            save_fingerprints()
+    elif os.path.exists(os.path.join(BUILD_DIR, 'fingerprints.json')):
+        os.remove(os.path.join(BUILD_DIR, 'fingerprints.json'))
+
+    if SINGLE_RENDER:
+        places = site.jinja_values()
+        if places:
+            print ("Warning: jinja2 code out of boxes isn't rendered with SINGLE_RENDER (pages are "
+                "rendered once): %s%s") % (
+                ', '.join(places[:5]), len(places) > 5 and ' and %i more' % (len(places) - 5) or '')
+
+    # process pages in each language
+    tasks = []
+    for lang in site.languages:
+        for n, m in site.pages[lang].items():
+            # skip pages whose files, templates and settings didn't change
+            with PROFILE.phase('manifest checks'):
+                if MANIFEST.is_stale(page_output(m), page_sources(m), site.site_deps):
+                    tasks.append((lang, n))
+
+    with PROFILE.phase('render'):
+        render_pages(tasks, jobs)
+
+    # write sitemap index and shards
+    with PROFILE.phase('sitemap'):
+        write_sitemap(site)
+
+    if s.get('SEARCH'):
+        with PROFILE.phase('search index'):
+            write_search(site)
+    elif os.path.isdir(os.path.join(BUILD_DIR, 'search')):
+        shutil.rmtree(os.path.join(BUILD_DIR, 'search'))
+
+    if POST_PROCESS:
+        with PROFILE.phase('post process'):
+            post_process(jobs)
+
+    with PROFILE.phase('save state'):
+        if not (POST_PROCESS and POST_PROCESS[1]):
+            remove_compressed()
+        MANIFEST.clean()
+        prune_cache('thumbnails', thumbnail_keys())
+        remove_orphans(os.path.join(BUILD_DIR, 'static'))
+        MANIFEST.save()
+        if CONTENT_CACHE is not None:
+            # a shared cache is pruned once all projects are built, see build_batch()
+            CONTENT_CACHE.save(prune=not site.restored and SHARED_CACHE_DIR is None)
+        CATALOG_CACHE.save(prune=not site.restored)
+        save_output_cache()
+    with PROFILE.phase('deploy manifest'):
+        deploy = deploy_manifest(BUILD_DIR)
+    PROFILE.caches['manifest'] = [MANIFEST.fresh_count, MANIFEST.stale_count]
+    if incremental:
+        print "%i outputs rebuilt, %i up to date." % (MANIFEST.stale_count, MANIFEST.fresh_count)
+        print "%i files added, %i changed and %i removed (see %s)." % (len(deploy['added']),
+            len(deploy['changed']), len(deploy['removed']), os.path.join(CACHE_DIR, 'deploy.json'))
+    if stream:
+        peak, workers = peak_memory()
+        print "Peak memory: %.1f MB (worker processes: %.1f MB)." % (peak / 1024.0, workers / 1024.0)
+    if profile:
+        report = PROFILE.report()
+        json.dump(report, open(os.path.join(CACHE_DIR, 'profile.json'), 'w'), indent=2)
+        PROFILE.show(report)
+        print "\nProfile saved to %s." % os.path.join(CACHE_DIR, 'profile.json')
+    return site
+
+
+def build_batch(project_paths, cache_dir=None, **options):
+    """build several projects in this process, with caches keyed by content
+    (markdown, thumbnails, image variants, compiled templates and static
+    files) shared in cache_dir, and print the time of each one
+
+    Options are passed to build(). Projects that fail don't stop the batch.
+    Returns the paths of the failed ones.
+    """
+    global SHARED_CACHE_DIR
+    SHARED_CACHE_DIR = cache_dir and os.path.abspath(cache_dir)
+    SHARED_CACHES.clear()
+    CACHE_KEYS.clear()
+    timings = []
+    failed = []
+    start = time.time()
+    for path in project_paths:
+        print "Building %s..." % path
+        project_start = time.time()
+        try:
+            build(path, **options)
+        except (Exception, SystemExit), e:
+            if not isinstance(e, SystemExit):
+                traceback.print_exc()
+            failed.append(path)
+        shared = PROFILE.caches.get('static store', [0, 0])[0]
+        timings.append((path, time.time() - project_start, shared, path in failed))
+    # entries used by none of the projects are dropped
+    for cache in SHARED_CACHES.values():
+        cache.save(prune=not failed)
+    if not failed:
+        for name, keys in CACHE_KEYS.items():
+            prune_files(cache_path(name), keys)
+
+    print "\n%-40s %10s %14s" % ('project', 'seconds', 'shared static')
+    for path, seconds, shared, error in timings:
+        print "%-40s %10.2f %14i%s" % (path, seconds, shared, error and '  FAILED' or '')
+    print "%i projects built in %.2fs, %i failed." % (len(project_paths), time.time() - start, len(failed))
+    return failed
+
+def deploy_files(build_dir, previous):
+    """relative url -> [md5, size, mtime] of every file in build_dir but
+    .cache, only hashing the ones whose size or mtime differ in previous"""
+    files = {}
+    for root, dirs, names in os.walk(build_dir):
+        if root == build_dir and '.cache' in dirs:
+            dirs.remove('.cache')
+        for name in names:
+            if name.endswith('.tmp'):
+                continue # being written by another process
+            path = os.path.join(root, name)
+            st = os.stat(path)
+            url = '/'.join(os.path.relpath(path, build_dir).split(os.path.sep))
+            url = url.decode(sys.getfilesystemencoding() or 'utf-8') # as read from json
+            old = previous.get(url)
+            if old and old[1:] == [st.st_size, st.st_mtime]:
+                files[url] = old
+            else:
+                files[url] = [file_hash(path), st.st_size, st.st_mtime]
+    return files
+
+def deploy_manifest(build_dir, save=True):
+    """write build/.cache/deploy.json with the files of the build and their
+    hashes, and the ones added, changed and removed since the previous one
+
+    Outputs keep their mtime while their content doesn't change (see
+    write_output and sync_tree), so only changed files are hashed again.
+    Returns the manifest (only saved if save is True).
+    """
+    path = os.path.join(ensure_dir(os.path.join(build_dir, '.cache')), 'deploy.json')
+    previous = {}
+    if os.path.exists(path):
+        try:
+            previous = json.load(open(path))['files']
+        except (ValueError, KeyError):
+            print "Warning: ignoring broken deploy manifest %s." % path
+    files = deploy_files(build_dir, previous)
+    manifest = dict(files=files,
+        added=sorted([x for x in files if x not in previous]),
+        changed=sorted([x for x in files if x in previous and previous[x][0] != files[x][0]]),
+        removed=sorted([x for x in previous if x not in files]))
+    if not save:
+        return manifest
+    tmp = '%s.%i.tmp' % (path, os.getpid())
+    json.dump(manifest, open(tmp, 'w'), indent=1, sort_keys=True)
+    os.rename(tmp, path)
+    return manifest
+
+def publish_order(url):
+    """files that link others go after them: assets, pages, then indexes"""
+    if url == 'sitemap.xml' or url.endswith('/index.json'):
+        return 2, url
+    if url.endswith('.html'):
+        return 1, url
+    return 0, url
+
+def publish(project_path, target):
+    """copy the files of the build of a project that changed since the last
+    publish to the target directory, and remove the ones that are gone
+
+    Every file is written to a temporary name and renamed, so the target
+    never has half written files, and pages are copied after the assets
+    they link. What the target has is kept in its PUBLISH_MANIFEST, so
+    files are only compared by hash. Returns (copied, removed) file counts.
+    """
+    build_dir = os.path.join(project_path, 'build')
+    files = deploy_manifest(build_dir, save=False)['files'] # files changed by hand too
+    manifest_path = os.path.join(ensure_dir(target), PUBLISH_MANIFEST)
+    published = {}
+    if os.path.exists(manifest_path):
+        try:
+            published = json.load(open(manifest_path))
+        except ValueError:
+            print "Warning: ignoring broken publish manifest %s." % manifest_path
+
+    copied = 0
+    size = 0
+    for url in sorted(files, key=publish_order):
+        md5 = files[url][0]
+        dst = os.path.join(target, *url.split('/'))
+        if published.get(url) == md5 and os.path.exists(dst):
+            continue
+        if url not in published and os.path.exists(dst) and file_hash(dst) == md5:
+            published[url] = md5 # already there (first publish to that target)
+            continue
+        ensure_dir(os.path.dirname(dst))
+        link_or_copy(os.path.join(build_dir, *url.split('/')), dst, hardlink=False)
+        published[url] = md5
+        copied += 1
+        size += files[url][1]
+
+    removed = 0
+    for url in sorted(published):
+        if url in files:
+            continue
+        del published[url]
+        path = os.path.join(target, *url.split('/'))
+        if os.path.exists(path):
+            os.remove(path)
+            removed += 1
+        directory = os.path.dirname(path)
+        while directory != os.path.normpath(target) and os.path.isdir(directory) and not os.listdir(directory):
+            os.rmdir(directory)
+            directory = os.path.dirname(directory)
+
+    tmp = '%s.%i.tmp' % (manifest_path, os.getpid())
+    json.dump(published, open(tmp, 'w'), indent=1, sort_keys=True)
+    os.rename(tmp, manifest_path)
+    print "Published to %s: %i files copied (%i bytes), %i removed." % (target, copied, size, removed)
+    return copied, removed
+
+def read_batch(filename):
+    """project paths listed in filename, one per line (# starts a comment),
+    relative to the directory of the file"""
+    paths = []
+    for line in open(filename):
+        line = line.split('#')[0].strip()
+        if line:
+            paths.append(os.path.join(os.path.dirname(filename), line))
+    return paths
+
+
+def rebuild(site, changed, jobs=1):
+    """update the build after files in changed were modified (watch mode)
+
+    Changes in boxes, templates and static files are applied to the site in
+    memory and only the affected pages are rendered again. Any other change
+    (page.md, images, catalogs, config.yml, new or deleted files, static
+    images, catalogs and files included) loads the whole site again with an
+    incremental build.
+    Returns the site to use from now on.
+    """
+    MANIFEST.refresh()
+    boxes = {}
+    for lang, pages in site.pages.items():
+        for n, m in pages.items():
+            for key, box in m.boxes.items():
+                boxes[os.path.abspath(box.filename)] = (lang, n, key)
+    static_dir = os.path.abspath(site.static_dir) + os.path.sep
+    templates_dir = os.path.abspath(site.templates_dir) + os.path.sep
+    static_files = set([os.path.abspath(x[len(EXISTS_DEP):] if x.startswith(EXISTS_DEP) else x)
+        for x in site.site_deps])
+
+    tasks = set()
+    all_pages = False
+    static = False
+    for path in [os.path.abspath(x) for x in changed]:
+        if (path.startswith(static_dir) and path in static_files and os.path.exists(path)
+                and get_type(os.path.basename(path))[0] not in ('forbidden', 'image')):
+            static = True # site.static (css, js... of templates) is the same
+        elif path.startswith(templates_dir):
+            all_pages = True # jinja2 reloads templates by itself
+        elif path in boxes and os.path.exists(path):
+            lang, n, key = boxes[path]
+            m = site.pages[lang][n]
+            m.boxes[key] = Box(m.boxes[key].filename)
+            tasks.add((lang, n))
+        else:
+            return build(site.path, incremental=True, jobs=jobs)
+
+    if static:
+        sync_tree(site.static_dir, os.path.join(BUILD_DIR, 'static'))
+        if FINGERPRINTS is not None:
+            fingerprint_css(site.static_dir, os.path.join(BUILD_DIR, 'static'))
+            save_fingerprints()
+            all_pages = True # urls of assets may have changed
+        MANIFEST.clean()
+    if all_pages:
+        tasks = [(l, k) for l in site.languages for k in site.pages[l]]
+    render_pages(list(tasks), jobs)
+    if site.settings.get('SEARCH') and tasks:
+        write_search(site)
+    if POST_PROCESS:
+        post_process(jobs)
+        save_output_cache()
+    write_sitemap(site)
+    MANIFEST.save()
+    CONTENT_CACHE.save(prune=not site.restored)
+    deploy_manifest(BUILD_DIR)
+    return site
+
+
+class Watcher:
+    """Wait for changes in files under some directories.
+
+    Uses inotify (through pyinotify) when it's available and polls file
+    modification times otherwise.
+    """
+    def __init__(self, paths, interval=0.5):
+        self.paths = paths
+        self.interval = interval
+        self.changed = set()
+        if pyinotify:
+            self.wm = pyinotify.WatchManager()
+            mask = (pyinotify.IN_CLOSE_WRITE | pyinotify.IN_CREATE | pyinotify.IN_DELETE
+                | pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO)
+            for path in paths:
+                self.wm.add_watch(path, mask, rec=True, auto_add=True)
+            self.notifier = pyinotify.Notifier(self.wm, self.process_event, timeout=int(interval * 1000))
+        else:
+            self.snapshot = self.scan()
+
+    def process_event(self, event):
+        if not event.dir:
+            self.changed.add(event.pathname)
+
+    def scan(self):
+        """(mtime, size) of every file under paths"""
+        files = {}
+        for path in self.paths:
+            if os.path.isfile(path):
+                st = os.stat(path)
+                files[path] = (st.st_mtime, st.st_size)
+            for root, dirs, names in os.walk(path):
+                for name in names:
+                    filename = os.path.join(root, name)
+                    try:
+                        st = os.stat(filename)
+                    except OSError:
+                        continue
+                    files[filename] = (st.st_mtime, st.st_size)
+        return files
+
+    def wait(self):
+        """block until some files change and return their paths"""
+        while True:
+            if pyinotify:
+                if self.notifier.check_events():
+                    self.notifier.read_events()
+                    self.notifier.process_events()
+                elif self.changed: # nothing else happened during the last interval
+                    changed, self.changed = self.changed, set()
+                    changed = set([x for x in changed if self.interesting(x)])
+                    if changed:
+                        return changed
+            else:
+                time.sleep(self.interval)
+                files = self.scan()
+                changed = set(files) ^ set(self.snapshot)
+                changed.update([x for x in files if x in self.snapshot and files[x] != self.snapshot[x]])
+                self.snapshot = files
+                changed = set([x for x in changed if self.interesting(x)])
+                if changed:
+                    return changed
+
+    def interesting(self, path):
+        """skip hidden and backup files written by editors"""
+        name = os.path.basename(path)
+        return not (name.startswith('.') or name.endswith('~'))
+
+
+class DevHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    """Serve build/ adding a script to html pages that reloads them after each rebuild"""
+    root = None
+    generation = 0
+
+    def translate_path(self, path):
+        path = SimpleHTTPServer.SimpleHTTPRequestHandler.translate_path(self, path)
+        return os.path.join(self.root, os.path.relpath(path, os.getcwd()))
+
+    def do_GET(self):
+        if self.path.startswith(LIVE_RELOAD_URL):
+            self.send_text(str(DevHandler.generation), 'text/plain')
+            return
+        path = self.translate_path(self.path)
+        if os.path.isdir(path) and self.path.split('?')[0].endswith('/'):
+            path = os.path.join(path, 'index.html')
+        if path.endswith('.html') and os.path.isfile(path):
+            html = open(path, 'rb').read()
+            self.send_text(html.replace('</body>', LIVE_RELOAD_SCRIPT + '</body>'), 'text/html; charset=utf-8')
+            return
+        SimpleHTTPServer.SimpleHTTPRequestHandler.do_GET(self)
+
+    def send_text(self, body, content_type):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
         pass
-    shutil.copytree(STATIC_DIR, os.path.join(BUILD_DIR, 'static'))
 
 
-    # get pages and menu
-    pages = {} #TODO: Page class?
-    menu = {}
-    for lang in LANGUAGES:
-        #TODO: join menus and pages ??
-        menu[lang] = Item(os.path.join(RESOURCES_DIR, lang), lang=lang, level=0)
-        pages[lang] = walk(Item(os.path.join(RESOURCES_DIR, lang), lang=lang, level=0), items={})
+class DevServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
 
-    static = Item(STATIC_DIR)
-    
-    # process pages in each language
-    urls = []
-    for lang in LANGUAGES:
-        for n, m in pages[lang].items():
-            urls.append('%s/%s' % (s['DOMAIN'], m._url))
 
-            globals()['PAGE'] = m # current page goes to global 'page' var
-                        
+def watch(project_path, jobs=1, port=None):
+    """build project and rebuild it when its files change, serving build/ on port"""
+    site = build(project_path, incremental=True, jobs=jobs)
+    if port:
+        DevHandler.root = os.path.abspath(site.build_dir)
+        server = DevServer(('localhost', port), DevHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        print "Serving %s at http://localhost:%i/%s/" % (site.build_dir, port, site.languages[0])
+
+    watcher = Watcher([site.resources_dir, site.templates_dir, site.config_path])
+    print "Watching %s for changes, press Ctrl+C to stop." % project_path
+    try:
+        while True:
+            changed = watcher.wait()
+            start = time.time()
             try:
-                t = '%s.html' % m.template.strip() #template
-            except AttributeError:
-                print "Warning: Using default template for %s." % m
-                t = '%s.html' % s['DEFAULT_TEMPLATE']
-            t = ENV.get_template(t)
-
-            for root, dirs, files in os.walk(m.root):
-                boxes = {}
-                for file in files:
-                    #TODO: check extension (markdown, html, etc.)
-                    #process files except hiddens
-                    if not file.startswith('.'):
-                        box = Box(join(root, file))
-                        key = file.split('.')[0]
-                        boxes[key] = box
-
-                lang_pages = {}
-                for l in LANGUAGES:
-                    try:
-                        lang_pages[l] = pages[l][m.id]
-                    except KeyError:
-                        print "Warning: missing info for '%s' language." % l
-
-                # write output file
-                boxes['current_language'] = m.lang
-                boxes['builtins'] = builtins
-                boxes['page'] = m #TODO: better not in boxes?
-                boxes['lang_pages'] = lang_pages
-                menu_lang = menu[lang].children
-
-                # render templates twice in order to use jinja2 into markdown files
-                output_md = t.render(css=static.css, js=static.js, img=static.img, ico=static.ico, menu=menu_lang, gallery=GALLERY[lang], i18n=I18N[lang], **boxes)
-                # add target to external links
-                output_md = output_md.replace('<a href="http:', '<a target=\'_blank\' href="http:')
-                
-                t_md = ENV.from_string(output_md)
-                output = t_md.render(css=static.css, js=static.js, img=static.img, ico=static.ico, menu=menu_lang, gallery=GALLERY[lang], i18n=I18N[lang], **boxes)
-
-                # save html file
-                try:
-                    os.makedirs(os.path.join(BUILD_DIR, os.path.join(*m.root.split(os.path.sep)[-m.level-1:])))
-                    print "directory %s created." % os.path.join(BUILD_DIR, m.lang, os.path.join(m.root.split(os.path.sep)[-m.level-1:]))
-                except:
-                    pass
-                codecs.open(os.path.join(BUILD_DIR, m.lang, os.path.join(*m.root.split(os.path.sep)[-m.level:]), 'index.html'), 'w', 'utf-8').write(output)
-
-    # write sitemap xml file
-    # jinja2 can't do {{ spaceless }} :-(
-    sitemap_lines = sitemap_template.render(urls=urls, today=date.today().strftime('%Y-%M-%d'), page=m).split('\n')
-    xml = '\n'.join([x for x in sitemap_lines if x.strip()])
-    open('%s/sitemap.xml' % BUILD_DIR, 'w').write(xml)
+                site = rebuild(site, changed, jobs)
+            except Exception:
+                traceback.print_exc()
+                continue
+            DevHandler.generation += 1
+            print "%i files changed, rebuilt in %.2fs." % (len(changed), time.time() - start)
+    except KeyboardInterrupt:
+        pass
 
 if __name__ == '__main__':
-    len_argv = len(sys.argv)
-    if len_argv == 1:
-        project_path = os.path.curdir
-    if len_argv != 2:
-        sys.exit('Usage: %s path/to/project' % sys.argv[0])
-
-    project_path = sys.argv[1].endswith(os.path.sep) and sys.argv[1][:-1] or sys.argv[1] #nice line!!! :-)
-    build(project_path)
+    parser = OptionParser(usage='%prog [options] path/to/project [path/to/project...]', version=__version__)
+    parser.add_option('-i', '--incremental', action='store_true', default=False,
+        help='only rebuild outputs whose sources changed since the last build')
+    parser.add_option('-j', '--jobs', type='int', default=1, metavar='N',
+        help='render pages in N worker processes')
+    parser.add_option('-p', '--profile', action='store_true', default=False,
+        help='print timings by phase, template and page (saved to build/.cache/profile.json)')
+    parser.add_option('--stream', action='store_true', default=False,
+        help='load, render and drop boxes one page at a time to bound memory use '
+            '(image headers and catalogs are still kept for the whole build)')
+    parser.add_option('--max-memory', type='int', default=None, metavar='MB',
+        help='free caches when a process uses more than MB megabytes (implies --stream)')
+    parser.add_option('-b', '--batch', default=None, metavar='FILE',
+        help='also build the projects listed in FILE (one path per line)')
+    parser.add_option('--cache-dir', default=None, metavar='DIR',
+        help='share caches of markdown, images, templates and static files in DIR')
+    parser.add_option('--publish', default=None, metavar='DIR',
+        help='after the build, copy the files that changed since the last publish to DIR')
+    parser.add_option('-w', '--watch', action='store_true', default=False,
+        help='rebuild when resources, templates or config.yml change')
+    parser.add_option('-s', '--serve', type='int', default=None, metavar='PORT',
+        help='watch and serve build/ on http://localhost:PORT with live reload')
+    options, args = parser.parse_args()
+    if options.batch:
+        args.extend(read_batch(options.batch))
+    project_paths = [x.rstrip(os.path.sep) or x for x in args] or [os.path.curdir] #nice line!!! :-)
+    batch = len(project_paths) > 1 or options.cache_dir
+    if (options.watch or options.serve or options.publish) and batch:
+        parser.error('watch, serve and publish only work with one project')
+
+    build_options = dict(incremental=options.incremental, jobs=options.jobs, profile=options.profile,
+        stream=options.stream or bool(options.max_memory), max_memory=options.max_memory)
+    if options.watch or options.serve:
+        watch(project_paths[0], jobs=options.jobs, port=options.serve)
+    elif batch:
+        if build_batch(project_paths, cache_dir=options.cache_dir, **build_options):
+            sys.exit(1)
+    else:
+        build(project_paths[0], **build_options)
+        if options.publish:
+            publish(project_paths[0], options.publish)